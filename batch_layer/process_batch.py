@@ -1,7 +1,26 @@
 import duckdb
+import glob
+import json
+import multiprocessing
 import os
-import pandas as pd
-from datetime import datetime
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from monitoring.metrics import get_registry
+from monitoring.profiling import Profiler
+from common.sketches import SKETCH_DIR, write_sketches
+from common.storage import parquet_copy_options
 
 # Path Setup
 env_base = os.getenv("LAMBDA_BASE_DIR")
@@ -11,30 +30,289 @@ else:
     BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     
 DATA_DIR = os.path.join(BASE_DIR, "data")
+BATCH_VIEW_DIR = os.path.join(DATA_DIR, "processed", "batch_views")
+BATCH_STAGING_DIR = os.path.join(DATA_DIR, "processed", "batch_staging")
+STAGED_HISTORY_FILE = os.path.join(BATCH_STAGING_DIR, "history.parquet").replace('\\', '/')
+# Per-partition fingerprints of the last run, used by backfills to find changed dates
+BATCH_MANIFEST_FILE = os.path.join(DATA_DIR, "batch_manifest.json")
 
-def process_batch():
-    print("Starting Batch Layer Processing (via DuckDB)...")
-    
-    # Paths
-    raw_history_glob = os.path.join(DATA_DIR, "raw", "batch", "*.json").replace('\\', '/')
-    users_path = os.path.join(DATA_DIR, "master", "users.csv").replace('\\', '/')
-    output_dir = os.path.join(DATA_DIR, "processed", "batch_views")
-    output_file = os.path.join(output_dir, "batch_data.parquet").replace('\\', '/')
-    
-    os.makedirs(output_dir, exist_ok=True)
+# The batch view is one flat file per event date, batch_data_<YYYY-MM-DD>.parquet
+PARTITION_PREFIX = "batch_data_"
+UNDATED_PARTITION = "undated"
 
-    con = duckdb.connect()
+# Each run builds a complete generation of the view (partitions, their sketches and the
+# transaction_id indexes) in its own directory, gen_<n>, and publishes it by rewriting CURRENT
+BATCH_CURRENT_FILE = os.path.join(BATCH_VIEW_DIR, "CURRENT")
+GENERATION_PREFIX = "gen_"
+BATCH_SKETCH_SUBDIR = "_sketches"
+# Held by every run that builds and publishes a generation
+BATCH_LOCK_FILE = os.path.join(BATCH_VIEW_DIR, ".lock")
+
+# Partition rebuilds run in a process pool; each worker's DuckDB gets its own memory budget
+# (spilling to disk beyond it) so the pool as a whole stays within workers x budget
+BATCH_WORKERS = int(os.getenv("LAMBDA_BATCH_WORKERS", str(min(4, os.cpu_count() or 1))))
+BATCH_WORKER_MEMORY = os.getenv("LAMBDA_BATCH_WORKER_MEMORY", "1GB")
+
+# Batch views are clustered on transaction_id so each row group covers a narrow, disjoint id range
+# and point lookups can skip all but one of them using the Parquet min/max statistics. DuckDB
+# fills row groups in whole 2048-row vectors, so smaller sizes act as 2048
+BATCH_ROW_GROUP_SIZE = int(os.getenv("LAMBDA_BATCH_ROW_GROUP_SIZE", "122880"))
+TXID_INDEX_FILE = "_txid_index.json"
+# Global transaction_id -> batch file map; in a subdirectory so the view's *.parquet glob skips it
+TXID_MAP_FILE = os.path.join("_index", "txid_map.parquet")
+
+USERS_FILE = os.path.join(DATA_DIR, "master", "users.parquet")
+USERS_UPDATES_DIR = os.path.join(DATA_DIR, "master", "users_updates")
+# Users upsert files whose changes are already reflected in the batch view
+USERS_CHECKPOINT_FILE = os.path.join(DATA_DIR, "users_enrichment_checkpoint.txt")
+
+def _sql_path_list(paths):
+    return "[" + ", ".join("'" + p.replace('\\', '/').replace("'", "''") + "'" for p in paths) + "]"
+
+def list_user_updates():
+    """Pending and applied users upsert files, oldest first."""
+    if not os.path.isdir(USERS_UPDATES_DIR):
+        return []
+    return sorted(f for f in os.listdir(USERS_UPDATES_DIR) if f.endswith('.parquet'))
+
+def read_applied_user_updates(checkpoint_file=USERS_CHECKPOINT_FILE):
+    if not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+def write_applied_user_updates(update_files, checkpoint_file=USERS_CHECKPOINT_FILE):
+    tmp_path = f"{checkpoint_file}.tmp"
+    with open(tmp_path, 'w') as f:
+        for f_name in sorted(update_files):
+            f.write(f_name + "\n")
+    os.replace(tmp_path, checkpoint_file)
+
+def create_user_upserts_view(con, update_files, view_name="user_upserts"):
+    """Latest upserted row per user_id across `update_files` (later files win)."""
+    paths = [os.path.join(USERS_UPDATES_DIR, f) for f in update_files]
+    if not paths:
+        con.execute(f"CREATE OR REPLACE VIEW {view_name} AS SELECT * FROM read_parquet('{USERS_FILE.replace(os.sep, '/')}') LIMIT 0")
+        return
+    con.execute(f"""
+        CREATE OR REPLACE VIEW {view_name} AS
+        SELECT user_id, name, region, signup_date
+        FROM read_parquet({_sql_path_list(paths)}, filename=true)
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY filename DESC) = 1
+    """)
 
+def create_users_view(con, update_files):
+    """`users_master`: the Parquet users master with the given upserts laid over it."""
+    create_user_upserts_view(con, update_files)
+    con.execute(f"""
+        CREATE OR REPLACE VIEW users_master AS
+        SELECT user_id, name, region, signup_date FROM user_upserts
+        UNION ALL
+        SELECT b.user_id, b.name, b.region, b.signup_date
+        FROM read_parquet('{USERS_FILE.replace(os.sep, '/')}') b
+        ANTI JOIN user_upserts u ON b.user_id = u.user_id
+    """)
+
+def _execute(con, sql):
+    return con.execute(sql).fetchall()
+
+def write_txid_index(con, output_dir, execute=None):
+    """
+    Writes the side index mapping transaction_id ranges to batch view files and row groups,
+    read from each file's Parquet footer. The file's mtime is recorded so readers can tell
+    when an entry is stale; entries of unchanged files are carried over without a re-read.
+    `execute(con, sql)` runs the queries, e.g. a job's Profiler.execute so they are profiled.
+    """
+    execute = execute or _execute
+    index_path = os.path.join(output_dir, TXID_INDEX_FILE)
+    previous = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            previous = json.load(f).get("files", {})
+    files = sorted(glob.glob(os.path.join(output_dir, "*.parquet")))
+    index = {"column": "transaction_id", "files": {}}
+    changed = []
+    for path in files:
+        name = os.path.basename(path)
+        mtime = os.path.getmtime(path)
+        if name in previous and previous[name]["mtime"] == mtime:
+            index["files"][name] = previous[name]
+            continue
+        changed.append(path)
+        rows = execute(con, f"""
+            SELECT row_group_id, row_group_num_rows, stats_min_value, stats_max_value
+            FROM parquet_metadata({_sql_path_list([path])})
+            WHERE path_in_schema = 'transaction_id'
+            ORDER BY row_group_id
+        """)
+        index["files"][name] = {
+            "mtime": mtime,
+            "row_groups": [[rg, n, lo, hi] for rg, n, lo, hi in rows],
+        }
+    # The map goes first: until the index is replaced, files it re-read still look stale to readers
+    if changed or set(previous) != set(index["files"]) or not os.path.exists(os.path.join(output_dir, TXID_MAP_FILE)):
+        write_txid_map(con, output_dir, files, changed, execute)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+def write_txid_map(con, output_dir, files, changed, execute=None):
+    """
+    Writes the global transaction_id -> batch file map, sorted on transaction_id so a lookup
+    reads one of its row groups instead of probing every date partition. Ids of files not in
+    `changed` are carried over from the previous map rather than re-read from the view.
+    """
+    execute = execute or _execute
+    map_path = os.path.join(output_dir, TXID_MAP_FILE).replace('\\', '/')
+    os.makedirs(os.path.dirname(map_path), exist_ok=True)
+    if not files:
+        if os.path.exists(map_path):
+            os.remove(map_path)
+        return
+    if not os.path.exists(map_path):
+        changed = files
+    changed_names = {os.path.basename(p) for p in changed}
+    kept = [os.path.basename(p) for p in files if os.path.basename(p) not in changed_names]
+    parts = []
+    if kept:
+        names = ", ".join(f"'{n}'" for n in kept)
+        parts.append(f"SELECT transaction_id, file FROM read_parquet('{map_path}') WHERE file IN ({names})")
+    if changed:
+        parts.append(f"SELECT transaction_id, parse_filename(filename) AS file FROM read_parquet({_sql_path_list(changed)}, filename = true)")
+    tmp_path = os.path.join(os.path.dirname(map_path), f".{os.path.basename(map_path)}.tmp").replace('\\', '/')
+    execute(con, f"""
+        COPY (
+            {" UNION ALL ".join(parts)}
+            ORDER BY transaction_id
+        ) TO '{tmp_path}' ({parquet_copy_options(BATCH_ROW_GROUP_SIZE)});
+    """)
+    os.replace(tmp_path, map_path)
+
+def partition_path(partition, gen_dir):
+    return os.path.join(gen_dir, f"{PARTITION_PREFIX}{partition}.parquet")
+
+def partition_sketch_path(partition, gen_dir):
+    return os.path.join(gen_dir, BATCH_SKETCH_SUBDIR, f"{PARTITION_PREFIX}{partition}.parquet")
+
+def current_generation():
+    """Directory of the published batch view generation, or None before the first run."""
     try:
-        # Step-by-step for better debugging
-        print(f"Reading batch data from {raw_history_glob}")
-        con.execute(f"CREATE OR REPLACE VIEW raw_history AS SELECT * FROM read_json_auto('{raw_history_glob}')")
-        
-        print(f"Reading users from {users_path}")
-        con.execute(f"CREATE OR REPLACE VIEW users_master AS SELECT * FROM read_csv_auto('{users_path}')")
-        
-        print("Transforming and writing to Parquet...")
-        query = f"""
+        with open(BATCH_CURRENT_FILE, 'r') as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(BATCH_VIEW_DIR, name) if name else None
+
+@contextmanager
+def batch_view_lock():
+    """
+    Serializes the runs that build and publish generations (run_batch, refresh_user_enrichment):
+    an overlapping run waits rather than building the same generation number. It is an OS file
+    lock, so a crashed run never leaves it held.
+    """
+    os.makedirs(BATCH_VIEW_DIR, exist_ok=True)
+    with open(BATCH_LOCK_FILE, 'a+') as f:
+        f.seek(0)
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def begin_generation():
+    """
+    Creates the next generation directory, seeded with hard links to every file of the
+    published one (copies where links are unsupported). Rebuilt files are renamed over their
+    link, which leaves the published generation untouched until publish_generation().
+    Call it holding batch_view_lock().
+    """
+    current = current_generation()
+    number = int(os.path.basename(current)[len(GENERATION_PREFIX):]) + 1 if current else 1
+    gen_dir = os.path.join(BATCH_VIEW_DIR, f"{GENERATION_PREFIX}{number:06d}")
+    # Left over from a run that crashed before publishing (no other run can be building it under the lock)
+    shutil.rmtree(gen_dir, ignore_errors=True)
+    os.makedirs(os.path.join(gen_dir, BATCH_SKETCH_SUBDIR))
+    if current:
+        for root, _, files in os.walk(current):
+            target = os.path.join(gen_dir, os.path.relpath(root, current))
+            os.makedirs(target, exist_ok=True)
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    os.link(os.path.join(root, name), os.path.join(target, name))
+                except OSError:
+                    shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+    return gen_dir
+
+def publish_generation(gen_dir):
+    """
+    Points CURRENT at `gen_dir` with a single rename, so readers move from one complete view
+    to the next and never see a run's partitions half swapped in. The generation it replaces
+    is kept for queries still scanning it; older ones are removed.
+    """
+    previous = current_generation()
+    tmp_path = f"{BATCH_CURRENT_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(os.path.basename(gen_dir))
+    os.replace(tmp_path, BATCH_CURRENT_FILE)
+    keep = {os.path.basename(gen_dir), os.path.basename(previous) if previous else None}
+    for name in os.listdir(BATCH_VIEW_DIR):
+        if name.startswith(GENERATION_PREFIX) and name not in keep:
+            shutil.rmtree(os.path.join(BATCH_VIEW_DIR, name), ignore_errors=True)
+
+def remove_flat_layout():
+    """Removes the view files of the layout before generations, kept in BATCH_VIEW_DIR itself."""
+    for path in glob.glob(os.path.join(BATCH_VIEW_DIR, "*.parquet")) + glob.glob(os.path.join(BATCH_VIEW_DIR, TXID_INDEX_FILE)):
+        os.remove(path)
+    for directory in (os.path.join(BATCH_VIEW_DIR, os.path.dirname(TXID_MAP_FILE)), os.path.join(SKETCH_DIR, "batch")):
+        shutil.rmtree(directory, ignore_errors=True)
+
+def list_partitions(gen_dir=None):
+    """Date partitions in a batch view generation (the published one by default)."""
+    gen_dir = gen_dir or current_generation()
+    return sorted(
+        f[len(PARTITION_PREFIX):-len(".parquet")]
+        for f in os.listdir(gen_dir) if f.startswith(PARTITION_PREFIX) and f.endswith(".parquet")
+    ) if gen_dir and os.path.isdir(gen_dir) else []
+
+def read_partition_manifest():
+    if not os.path.exists(BATCH_MANIFEST_FILE):
+        return {}
+    with open(BATCH_MANIFEST_FILE, 'r') as f:
+        return json.load(f)["partitions"]
+
+def write_partition_manifest(partitions):
+    tmp_path = f"{BATCH_MANIFEST_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"partitions": partitions}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, BATCH_MANIFEST_FILE)
+
+def stage_history(con, raw_history_glob, profiler):
+    """
+    Deduplicates the raw history once into a staging Parquet file sorted by the date of each
+    transaction's winning record, so partition rebuilds only read their own row groups.
+    Returns {partition: fingerprint} where the fingerprint (row count and an order-independent
+    hash of the deduplicated rows) changes whenever the partition's content would.
+    """
+    with profiler.stage("read_json") as stage:
+        con.execute(f"CREATE OR REPLACE VIEW raw_history AS SELECT * FROM read_json_auto('{raw_history_glob}', format='newline_delimited', ignore_errors=true)")
+        if profiler.enabled:
+            # Materialise the scan on its own so JSON parsing cost is visible separately
+            stage["rows"] = profiler.execute(con, "SELECT COUNT(*) FROM raw_history")[0][0]
+
+    os.makedirs(BATCH_STAGING_DIR, exist_ok=True)
+    with profiler.stage("stage_history") as stage:
+        stage["rows"] = profiler.execute(con, f"""
             COPY (
                 WITH deduplicated AS (
                     SELECT 
@@ -47,30 +325,312 @@ def process_batch():
                         ROW_NUMBER() OVER(PARTITION BY transaction_id ORDER BY timestamp DESC) as rn
                     FROM raw_history
                 )
+                SELECT * EXCLUDE (rn), COALESCE(CAST(CAST(timestamp AS DATE) AS VARCHAR), '{UNDATED_PARTITION}') AS partition
+                FROM deduplicated
+                WHERE rn = 1
+                ORDER BY partition
+            ) TO '{STAGED_HISTORY_FILE}' ({parquet_copy_options()});
+        """)[0][0]
+        rows = profiler.execute(con, f"""
+            SELECT partition, COUNT(*), bit_xor(hash(transaction_id, user_id, product, amount, timestamp, status))
+            FROM read_parquet('{STAGED_HISTORY_FILE}')
+            GROUP BY partition
+        """)
+    return {partition: f"{count}:{digest}" for partition, count, digest in rows}
+
+def rebuild_partition(partition, gen_dir, user_updates, memory_limit=BATCH_WORKER_MEMORY, threads=None, profile=None,
+                      row_group_size=BATCH_ROW_GROUP_SIZE):
+    """
+    Rebuilds one date partition of the batch view generation `gen_dir` from the staged
+    history: users join, transaction_id sort, Parquet write to a temp file renamed over the
+    partition's link to the published file, then its sketches. Runs in a pool worker with
+    its own DuckDB memory budget.
+    Returns (partition, rows written, profile stage records).
+    """
+    profiler = Profiler("batch", enabled=profile)
+    con = duckdb.connect()
+    con.execute(f"SET memory_limit = '{memory_limit}'")
+    if threads:
+        con.execute(f"SET threads = {int(threads)}")
+    con.execute(f"SET temp_directory = '{os.path.join(BATCH_STAGING_DIR, 'spill').replace(os.sep, '/')}'")
+
+    dst = partition_path(partition, gen_dir)
+    tmp_path = os.path.join(gen_dir, f".{os.path.basename(dst)}.tmp").replace('\\', '/')
+    with profiler.stage("partition") as stage:
+        stage["partition"] = partition
+        create_users_view(con, user_updates)
+        rows = profiler.execute(con, f"""
+            COPY (
                 SELECT 
-                    d.transaction_id, 
-                    d.user_id, 
-                    d.product, 
-                    d.amount, 
-                    d.timestamp, 
-                    d.status,
+                    s.transaction_id, 
+                    s.user_id, 
+                    s.product, 
+                    s.amount, 
+                    s.timestamp, 
+                    s.status,
                     u.name as user_name,
                     u.region,
                     now() as processed_at
-                FROM deduplicated d
-                LEFT JOIN users_master u ON d.user_id = u.user_id
-                WHERE d.rn = 1
-            ) TO '{output_file}' (FORMAT PARQUET);
-        """
-        con.execute(query)
-        
-        count = con.execute(f"SELECT COUNT(*) FROM read_parquet('{output_file}')").fetchone()[0]
-        print(f"Batch Processing Complete. Processed {count} records into {output_file}")
+                FROM read_parquet('{STAGED_HISTORY_FILE}') s
+                LEFT JOIN users_master u ON s.user_id = u.user_id
+                WHERE s.partition = '{partition}'
+                ORDER BY s.transaction_id
+            ) TO '{tmp_path}' ({parquet_copy_options(row_group_size)});
+        """)[0][0]
+        stage["rows"] = rows
+        if rows == 0:
+            # The date no longer has any records: drop the partition instead of leaving it stale
+            for path in (tmp_path, dst, partition_sketch_path(partition, gen_dir)):
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            os.replace(tmp_path, dst)
+    if rows:
+        with profiler.stage("sketches") as stage:
+            stage["partition"] = partition
+            write_sketches(con, f"read_parquet('{dst.replace(os.sep, '/')}')", partition_sketch_path(partition, gen_dir),
+                           execute=profiler.execute)
+    con.close()
+    return partition, rows, profiler.stages
+
+def rebuild_partitions(partitions, gen_dir, user_updates, workers=None, memory_limit=None, profile=None, row_group_size=None):
+    """Rebuilds `partitions` of `gen_dir` across a process pool (in-process for one worker or partition)."""
+    workers = max(1, min(workers or BATCH_WORKERS, len(partitions)))
+    memory_limit = memory_limit or BATCH_WORKER_MEMORY
+    row_group_size = row_group_size or BATCH_ROW_GROUP_SIZE
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    if workers == 1:
+        return [rebuild_partition(p, gen_dir, user_updates, memory_limit, None, profile, row_group_size) for p in partitions]
+    # Workers must not be forked from a process holding DuckDB connections and threads;
+    # forkserver starts them from a clean server process (spawn where it is unavailable)
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+        futures = [pool.submit(rebuild_partition, p, gen_dir, user_updates, memory_limit, threads, profile, row_group_size) for p in partitions]
+        return [f.result() for f in futures]
+
+def run_batch(start=None, end=None, full=True, workers=None, memory_limit=None, profile=None, row_group_size=None):
+    """
+    Shared driver of the full rebuild and backfills. The raw history is always deduplicated
+    once (it is not partitioned, so every run must read it), then only the selected date
+    partitions are rebuilt in parallel:
+      full=True        every partition, and partitions without data are removed
+      start/end        partitions in [start, end] (dates, inclusive), whether changed or not
+      otherwise        partitions whose fingerprint differs from the last run's manifest
+    Without a published generation (first run, or a view from before generations) every run
+    is a full rebuild. The run is built as a new generation and published only once verified,
+    holding batch_view_lock() so overlapping runs and user refreshes wait for each other.
+    Returns the sorted list of partitions rebuilt or removed.
+    """
+    raw_history_glob = os.path.join(DATA_DIR, "raw", "batch", "*.json").replace('\\', '/')
+    with batch_view_lock():
+        return _run_batch_locked(raw_history_glob, start, end, full, workers, memory_limit, profile, row_group_size)
+
+def _run_batch_locked(raw_history_glob, start, end, full, workers, memory_limit, profile, row_group_size):
+    if current_generation() is None:
+        full = True
+
+    metrics = get_registry("batch")
+    profiler = Profiler("batch", enabled=profile)
+    job_start = time.perf_counter()
+    con = duckdb.connect()
+    # The history dedup gets the same memory budget (and spill directory) as each partition worker
+    os.makedirs(BATCH_STAGING_DIR, exist_ok=True)
+    con.execute(f"SET memory_limit = '{memory_limit or BATCH_WORKER_MEMORY}'")
+    con.execute(f"SET temp_directory = '{os.path.join(BATCH_STAGING_DIR, 'spill').replace(os.sep, '/')}'")
+    gen_dir = None
+
+    try:
+        print(f"Reading batch data from {raw_history_glob}")
+        fingerprints = stage_history(con, raw_history_glob, profiler)
+        previous = read_partition_manifest()
+        gen_dir = begin_generation()
+        existing = set(list_partitions(gen_dir))
+
+        if full:
+            selected = sorted(fingerprints)
+            removed = sorted(existing - set(fingerprints))
+        elif start or end:
+            lo, hi = str(start or "0000-00-00"), str(end or "9999-99-99")
+            in_range = lambda p: p != UNDATED_PARTITION and lo <= p <= hi
+            selected = sorted(p for p in fingerprints if in_range(p))
+            removed = sorted(p for p in existing if in_range(p) and p not in fingerprints)
+        else:
+            selected = sorted(p for p, fp in fingerprints.items() if previous.get(p) != fp or p not in existing)
+            removed = sorted(existing - set(fingerprints))
+
+        # Snapshot the upsert files up front; anything arriving later is left to refresh_user_enrichment
+        user_updates = list_user_updates()
+        print(f"Rebuilding {len(selected)} date partitions (removing {len(removed)}) with {len(user_updates)} users upsert files...")
+        results = rebuild_partitions(selected + removed, gen_dir, user_updates, workers, memory_limit, profile, row_group_size)
+        for _, _, stages in results:
+            profiler.stages.extend(stages)
+        written = {p: rows for p, rows, _ in results}
+
+        with profiler.stage("verify_output") as stage:
+            rebuilt = [partition_path(p, gen_dir).replace('\\', '/') for p in selected if written.get(p)]
+            count = profiler.execute(con, f"SELECT COUNT(*) FROM read_parquet({_sql_path_list(rebuilt)})")[0][0] if rebuilt else 0
+            expected = sum(int(fingerprints[p].split(":")[0]) for p in selected)
+            if count != expected:
+                raise RuntimeError(f"Batch view verification failed: wrote {count} rows, staged {expected}")
+            stage["rows"] = count
+
+        if full:
+            # Files carried over that no partition produces any more (e.g. an older layout's) are superseded
+            keep = {os.path.basename(partition_path(p, gen_dir)) for p in fingerprints}
+            for directory in (gen_dir, os.path.join(gen_dir, BATCH_SKETCH_SUBDIR)):
+                for path in glob.glob(os.path.join(directory, "*.parquet")):
+                    if os.path.basename(path) not in keep:
+                        os.remove(path)
+
+        with profiler.stage("txid_index") as stage:
+            index = write_txid_index(con, gen_dir, execute=profiler.execute)
+            stage["rows"] = sum(len(f["row_groups"]) for f in index["files"].values())
+        publish_generation(gen_dir)
+        if full:
+            remove_flat_layout()
+        # Only partitions this run rebuilt or removed get their new fingerprint; the others keep
+        # the one they were built from, so a later changed-only backfill still sees them as stale
+        manifest = {} if full else dict(previous)
+        manifest.update({p: fingerprints[p] for p in selected})
+        for p in removed:
+            manifest.pop(p, None)
+        write_partition_manifest(manifest)
+        if full:
+            write_applied_user_updates(user_updates)
+        os.remove(STAGED_HISTORY_FILE)
+        print(f"Batch Processing Complete. Processed {count} records into {len(selected)} partitions of {gen_dir}")
+
+        metrics.inc("lambda_files_ingested_total", len(glob.glob(raw_history_glob)), layer="batch")
+        metrics.inc("lambda_rows_written_total", count, layer="batch")
+        metrics.observe("lambda_batch_job_duration_seconds", time.perf_counter() - job_start)
+        metrics.set("lambda_last_run_timestamp_seconds", time.time(), layer="batch")
+        metrics.flush()
+        profiler.write_report()
+        return sorted(selected + removed)
 
     except Exception as e:
         print(f"Error in Batch Layer: {e}")
+        # The published generation is untouched; drop the unpublished one
+        if gen_dir and gen_dir != current_generation():
+            shutil.rmtree(gen_dir, ignore_errors=True)
         # Re-raise to let orchestrator/tests know
         raise e
+    finally:
+        con.close()
+
+def process_batch(profile=None, workers=None, memory_limit=None, row_group_size=None):
+    """Rebuilds the whole batch view. `profile=True` (or LAMBDA_PROFILE=1) writes a per-stage profile report."""
+    print("Starting Batch Layer Processing (via DuckDB)...")
+    run_batch(full=True, workers=workers, memory_limit=memory_limit, profile=profile, row_group_size=row_group_size)
+
+def backfill(start=None, end=None, workers=None, memory_limit=None, profile=None, row_group_size=None):
+    """
+    Reprocesses corrected history: rebuilds the date partitions in [start, end], or without a
+    range only the partitions whose deduplicated content changed since the last run.
+    """
+    print("Starting Batch Layer Backfill (via DuckDB)...")
+    return run_batch(start=start, end=end, full=False, workers=workers, memory_limit=memory_limit, profile=profile,
+                     row_group_size=row_group_size)
+
+def refresh_user_enrichment(profile=None):
+    """
+    Applies users upsert files not yet reflected in the batch view without a full rebuild.
+    Only the changed users are joined, and only batch view files holding their transactions
+    are rewritten, into a new generation published once all of them are done.
+    Returns the number of re-enriched rows.
+    """
+    with batch_view_lock():
+        return _refresh_user_enrichment_locked(profile)
+
+def _refresh_user_enrichment_locked(profile):
+    applied = read_applied_user_updates()
+    pending = [f for f in list_user_updates() if f not in applied]
+    if not pending:
+        return 0
+    if current_generation() is None:
+        # Nothing published to re-enrich; the next full run applies the upserts
+        print("No published batch view generation; run the batch job first.")
+        return 0
+
+    output_dir = begin_generation()
+    metrics = get_registry("batch")
+    profiler = Profiler("batch", enabled=profile)
+    job_start = time.perf_counter()
+    con = duckdb.connect()
+    create_user_upserts_view(con, pending, view_name="changed_users")
+    print(f"Re-enriching batch view for {len(pending)} users upsert files...")
+
+    updated = 0
+    rewritten = 0
+    files = sorted(glob.glob(os.path.join(output_dir, "*.parquet")))
+    affected_by_file = {}
+    if files:
+        # One scan of the user_id column across the view finds the files to rewrite
+        with profiler.stage("find_changed_users") as stage:
+            affected_by_file = {
+                os.path.basename(file): count for file, count in profiler.execute(con, f"""
+                    SELECT filename, COUNT(*) FROM read_parquet({_sql_path_list(files)}, filename = true)
+                    WHERE user_id IN (SELECT user_id FROM changed_users)
+                    GROUP BY filename
+                """)
+            }
+            stage["rows"] = sum(affected_by_file.values())
+    for path in files:
+        affected = affected_by_file.get(os.path.basename(path), 0)
+        if not affected:
+            continue
+        src = path.replace('\\', '/')
+        with profiler.stage("reenrich_users") as stage:
+            stage["file"] = os.path.basename(path)
+            stage["rows"] = affected
+            tmp_path = os.path.join(output_dir, f".{os.path.basename(path)}.tmp").replace('\\', '/')
+            profiler.execute(con, f"""
+                COPY (
+                    SELECT b.* REPLACE (
+                        CASE WHEN c.user_id IS NULL THEN b.user_name ELSE c.name END AS user_name,
+                        CASE WHEN c.user_id IS NULL THEN b.region ELSE c.region END AS region
+                    )
+                    FROM read_parquet('{src}') b
+                    LEFT JOIN changed_users c ON b.user_id = c.user_id
+                    ORDER BY b.transaction_id
+                ) TO '{tmp_path}' ({parquet_copy_options(BATCH_ROW_GROUP_SIZE)});
+            """)
+            os.replace(tmp_path, path)
+        updated += affected
+        rewritten += 1
+
+    if rewritten:
+        with profiler.stage("txid_index") as stage:
+            index = write_txid_index(con, output_dir, execute=profiler.execute)
+            stage["rows"] = sum(len(f["row_groups"]) for f in index["files"].values())
+        publish_generation(output_dir)
+    else:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    write_applied_user_updates(applied | set(pending))
+    print(f"Re-enriched {updated} rows in {rewritten} batch view files.")
+
+    metrics.inc("lambda_rows_written_total", updated, layer="batch_users")
+    metrics.observe("lambda_batch_job_duration_seconds", time.perf_counter() - job_start, run="user_refresh")
+    metrics.flush()
+    profiler.write_report()
+    return updated
 
 if __name__ == "__main__":
-    process_batch()
+    import argparse
+    parser = argparse.ArgumentParser(description="Batch layer job")
+    parser.add_argument("--refresh-users", action="store_true",
+                        help="Only apply new users upsert files to the existing batch view")
+    parser.add_argument("--backfill", action="store_true",
+                        help="Rebuild only changed date partitions (or those in --start/--end)")
+    parser.add_argument("--start", help="First date partition to backfill (YYYY-MM-DD)")
+    parser.add_argument("--end", help="Last date partition to backfill (YYYY-MM-DD, inclusive)")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="Partition rebuild processes")
+    parser.add_argument("--memory-limit", default=BATCH_WORKER_MEMORY, help="DuckDB memory budget per worker, e.g. 2GB")
+    parser.add_argument("--row-group-size", type=int, default=BATCH_ROW_GROUP_SIZE, help="Rows per Parquet row group of rebuilt partitions")
+    args = parser.parse_args()
+    if args.refresh_users:
+        refresh_user_enrichment()
+    elif args.backfill or args.start or args.end:
+        backfill(args.start, args.end, workers=args.workers, memory_limit=args.memory_limit, row_group_size=args.row_group_size)
+    else:
+        process_batch(workers=args.workers, memory_limit=args.memory_limit, row_group_size=args.row_group_size)
@@ -0,0 +1,100 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import duckdb
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_generator.generate_data import PRODUCTS, REGIONS
+from common.storage import parquet_copy_options
+
+# (label, parquet_copy_options kwargs); the first row is the pre-ZSTD default for comparison
+CONFIGURATIONS = [
+    ("snappy", dict(compression="snappy")),
+    ("uncompressed", dict(compression="uncompressed")),
+    ("zstd-1", dict(compression="zstd", level=1)),
+    ("zstd-3", dict(compression="zstd", level=3)),
+    ("zstd-9", dict(compression="zstd", level=9)),
+    ("zstd-3 no-dict", dict(compression="zstd", level=3, dictionary=False)),
+    ("zstd-3 rg-1M", dict(compression="zstd", level=3, row_group_size=1_000_000)),
+]
+
+# What the serving layer runs against the views: every column (as the unified view reads them) and
+# the KPI aggregates. Results are reduced in DuckDB so Python conversion isn't part of the timing
+SCAN_QUERIES = {
+    "full_scan": """
+        SELECT MAX(transaction_id), MAX(user_id), MAX(product), SUM(amount), MAX(timestamp),
+               MAX(status), MAX(user_name), MAX(region), CAST(MAX(processed_at) AS VARCHAR)
+        FROM read_parquet('{path}')
+    """,
+    "aggregate": "SELECT product, region, COUNT(*), SUM(amount) FROM read_parquet('{path}') GROUP BY ALL",
+}
+
+
+def build_view(con, rows):
+    """Batch-view-shaped table sorted on transaction_id, like rebuild_partition writes it."""
+    con.execute(f"""
+        CREATE TABLE view AS
+        SELECT
+            'tx_' || (100000 + hash(i) % 900000) || '_' || (100000 + hash(i + 1) % 900000) AS transaction_id,
+            CAST(1 + hash(i + 2) % 100000 AS BIGINT) AS user_id,
+            ({PRODUCTS})[1 + i % {len(PRODUCTS)}] AS product,
+            round(10 + random() * 1990, 2) AS amount,
+            TIMESTAMP '2024-01-01' + INTERVAL (i * 3) SECOND AS timestamp,
+            'COMPLETED' AS status,
+            'User_' || (1 + hash(i + 2) % 100000) AS user_name,
+            ({REGIONS})[1 + CAST(hash(i + 2) % {len(REGIONS)} AS BIGINT)] AS region,
+            now() AS processed_at
+        FROM range({rows}) r(i)
+        ORDER BY transaction_id
+    """)
+
+
+def best_of(con, sql, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        con.execute(sql).fetchall()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_configuration(con, out_dir, label, options, rows, repeats):
+    path = os.path.join(out_dir, label.replace(" ", "_") + ".parquet").replace('\\', '/')
+    start = time.perf_counter()
+    con.execute(f"COPY view TO '{path}' ({parquet_copy_options(**options)})")
+    write_sec = time.perf_counter() - start
+    result = {"config": label, "mb": os.path.getsize(path) / 1e6, "write_sec": write_sec}
+    for name, sql in SCAN_QUERIES.items():
+        result[f"{name}_rps"] = rows / best_of(con, sql.format(path=path), repeats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes on disk and scan speed of view files per Parquet configuration")
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--repeats", type=int, default=3, help="Scans per query; the fastest is reported")
+    args = parser.parse_args()
+
+    out_dir = tempfile.mkdtemp(prefix="lambda_bench_")
+    try:
+        con = duckdb.connect()
+        con.execute("SET enable_progress_bar = false")
+        build_view(con, args.rows)
+        results = [run_configuration(con, out_dir, label, options, args.rows, args.repeats) for label, options in CONFIGURATIONS]
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    baseline = results[0]["mb"]
+    print(f"\n{'config':<16}{'MB':>9}{'vs snappy':>11}{'write s':>10}{'full scan rows/s':>19}{'aggregate rows/s':>19}")
+    for r in results:
+        print(f"{r['config']:<16}{r['mb']:>9.2f}{r['mb'] / baseline:>10.0%}{r['write_sec']:>10.2f}"
+              f"{r['full_scan_rps']:>19,.0f}{r['aggregate_rps']:>19,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = tempfile.mkdtemp(prefix="lambda_bench_")
+# Layer modules resolve their data paths at import time, so point them at a scratch dir first
+os.environ["LAMBDA_BASE_DIR"] = BENCH_DIR
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_generator import generate_data as gen
+from speed_layer import process_stream as speed
+
+
+def reset_stream_state():
+    for path in (gen.STREAM_DIR, speed.SPEED_OUTPUT):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+    if os.path.exists(speed.CHECKPOINT_FILE):
+        os.remove(speed.CHECKPOINT_FILE)
+
+
+def run_format(fmt, batches):
+    reset_stream_state()
+    total_events = sum(t.num_rows for t in batches)
+    payloads = batches
+    if fmt == "json":
+        # Same events as the Arrow run, in the shape generate_stream_event produces
+        payloads = [
+            [dict(r, timestamp=r["timestamp"].strftime("%Y-%m-%d %H:%M:%S")) for r in t.to_pylist()]
+            for t in batches
+        ]
+
+    start = time.perf_counter()
+    for i, events in enumerate(payloads):
+        gen.write_stream_file(f"events_{i}_bench.{fmt}", events, fmt)
+    produce_sec = time.perf_counter() - start
+    drop_bytes = sum(os.path.getsize(os.path.join(gen.STREAM_DIR, f)) for f in os.listdir(gen.STREAM_DIR))
+
+    start = time.perf_counter()
+    files = speed.process_stream_micro_batch()
+    consume_sec = time.perf_counter() - start
+    assert files == len(batches), f"{fmt}: processed {files} of {len(batches)} files"
+
+    return {
+        "format": fmt,
+        "files": files,
+        "events": total_events,
+        "drop_mb": drop_bytes / 1e6,
+        "produce_eps": total_events / produce_sec,
+        "consume_eps": total_events / consume_sec,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Events/sec for JSON vs Arrow IPC stream micro-batches")
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=2000, help="Events per drop file")
+    args = parser.parse_args()
+
+    try:
+        n_batches = max(1, args.events // args.batch_size)
+        batches = [gen.generate_stream_batch(args.batch_size) for _ in range(n_batches)]
+        results = [run_format(fmt, batches) for fmt in ("json", "arrow")]
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+    print(f"\n{'format':<8}{'files':>8}{'events':>10}{'drop MB':>10}{'produce ev/s':>16}{'consume ev/s':>16}")
+    for r in results:
+        print(f"{r['format']:<8}{r['files']:>8}{r['events']:>10}{r['drop_mb']:>10.2f}{r['produce_eps']:>16,.0f}{r['consume_eps']:>16,.0f}")
+
+
+if __name__ == "__main__":
+    main()
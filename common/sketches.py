@@ -0,0 +1,107 @@
+import math
+import os
+
+# Path Setup
+env_base = os.getenv("LAMBDA_BASE_DIR")
+if env_base:
+    BASE_DIR = env_base
+else:
+    BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_DIR = os.path.join(BASE_DIR, "data")
+# Kept outside the speed view directory so its *.parquet glob never picks sketches up; batch
+# sketches live in each batch view generation (see batch_layer/process_batch.py)
+SKETCH_DIR = os.path.join(DATA_DIR, "processed", "sketches")
+SPEED_SKETCH_DIR = os.path.join(SKETCH_DIR, "speed")
+
+# HyperLogLog over user_id: 2^12 registers, ~1.6% standard error, at most 4096 rows per hour
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+
+# DDSketch-style amount histogram: log-spaced buckets, every quantile within 1% relative error
+QUANTILE_RELATIVE_ACCURACY = 0.01
+QUANTILE_GAMMA = (1 + QUANTILE_RELATIVE_ACCURACY) / (1 - QUANTILE_RELATIVE_ACCURACY)
+
+
+def sketch_sql(source, time_col="timestamp"):
+    """
+    SELECT producing the sketch rows of `source` (a table, view or table function call),
+    one set per hour in a long layout: (hour, kind, key, value) where
+      kind='hll':    key = register index, value = max rank (leading zeros + 1) seen
+      kind='amount': key = log-bucket index (NULL for amounts <= 0), value = count
+    Both merge by plain aggregation (max / sum), so hours, files and layers combine freely.
+    """
+    p = HLL_PRECISION
+    # Rank of the hash bits below the register index; bit_position counts from the top of all 64 bits
+    low_bits = f"(h & {(1 << (64 - p)) - 1}::UBIGINT)"
+    return f"""
+        WITH hashed AS (
+            SELECT date_trunc('hour', CAST({time_col} AS TIMESTAMP)) AS hour, hash(CAST(user_id AS BIGINT)) AS h, amount
+            FROM {source}
+            WHERE {time_col} IS NOT NULL
+        )
+        SELECT hour, 'hll' AS kind,
+            CAST(h >> {64 - p} AS BIGINT) AS key,
+            MAX(CASE WHEN {low_bits} = 0 THEN {65 - p} ELSE bit_position('1'::BIT, {low_bits}::BIT) - {p} END) AS value
+        FROM hashed
+        GROUP BY ALL
+        UNION ALL
+        SELECT hour, 'amount' AS kind,
+            CAST(CASE WHEN amount > 0 THEN CEIL(LN(amount) / {math.log(QUANTILE_GAMMA)!r}) END AS BIGINT) AS key,
+            COUNT(*) AS value
+        FROM hashed
+        GROUP BY ALL
+    """
+
+
+def write_sketches(con, source, dst, time_col="timestamp", execute=None):
+    """
+    Writes the hourly sketches of `source` to the Parquet file `dst` (temp file, then rename).
+    `execute(con, sql)` runs the COPY, e.g. a job's Profiler.execute so the query is profiled.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.tmp").replace('\\', '/')
+    sql = f"COPY ({sketch_sql(source, time_col)}) TO '{tmp_path}' (FORMAT PARQUET)"
+    if execute is None:
+        con.execute(sql)
+    else:
+        execute(con, sql)
+    os.replace(tmp_path, dst)
+
+
+def hll_estimate(registers):
+    """Cardinality from merged register values ({register: rank} or a list of ranks of non-empty registers)."""
+    ranks = list(registers.values()) if isinstance(registers, dict) else list(registers)
+    m = HLL_REGISTERS
+    zeros = m - len(ranks)
+    raw = (0.7213 / (1 + 1.079 / m)) * m * m / (zeros + sum(2.0 ** -r for r in ranks))
+    if raw <= 2.5 * m and zeros > 0:
+        # Small-range correction (linear counting)
+        return m * math.log(m / zeros)
+    return raw
+
+
+def bucket_value(key):
+    """Representative amount of a log bucket: within the relative accuracy of every value in it."""
+    if key is None:
+        return 0.0
+    return 2 * QUANTILE_GAMMA ** key / (QUANTILE_GAMMA + 1)
+
+
+def quantiles_from_buckets(buckets, quantiles=(0.5, 0.95)):
+    """Quantiles from merged (key, count) bucket counts; None when the sketch is empty."""
+    ordered = sorted(buckets, key=lambda b: (b[0] is not None, b[0] if b[0] is not None else 0))
+    total = sum(count for _, count in ordered)
+    result = {}
+    for q in quantiles:
+        if total == 0:
+            result[q] = None
+            continue
+        rank = q * (total - 1)
+        seen = 0
+        for key, count in ordered:
+            seen += count
+            if seen > rank:
+                result[q] = bucket_value(key)
+                break
+    return result
@@ -0,0 +1,51 @@
+import os
+
+import pyarrow.parquet as pq
+
+# Parquet settings for the batch and speed view files, shared by the DuckDB COPY and pyarrow writers
+PARQUET_COMPRESSION = os.getenv("LAMBDA_PARQUET_COMPRESSION", "zstd").lower()
+# Only applies to zstd; higher levels trade write time for size, scans are unaffected
+PARQUET_COMPRESSION_LEVEL = int(os.getenv("LAMBDA_PARQUET_COMPRESSION_LEVEL", "3"))
+# Dictionary pages for repeated strings; aggregates over product / region scan ~4x slower without them
+PARQUET_DICTIONARY = os.getenv("LAMBDA_PARQUET_DICTIONARY", "1") != "0"
+
+# Low-cardinality string columns of the views. DuckDB dictionary-encodes them on its own; pyarrow
+# writers are limited to these so they don't build dictionaries for unique ids first
+CATEGORICAL_COLUMNS = ("product", "status", "region")
+
+COMPRESSION_CODECS = ("zstd", "snappy", "gzip", "lz4", "uncompressed")
+
+
+def _settings(compression, level, dictionary):
+    compression = (compression or PARQUET_COMPRESSION).lower()
+    if compression not in COMPRESSION_CODECS:
+        raise ValueError(f"Unknown Parquet compression '{compression}', expected one of {COMPRESSION_CODECS}")
+    level = PARQUET_COMPRESSION_LEVEL if level is None else int(level)
+    dictionary = PARQUET_DICTIONARY if dictionary is None else dictionary
+    return compression, level, dictionary
+
+
+def parquet_copy_options(row_group_size=None, compression=None, level=None, dictionary=None):
+    """Options for a DuckDB `COPY ... TO 'file' (<options>)` writing a view file; None means the configured default."""
+    compression, level, dictionary = _settings(compression, level, dictionary)
+    options = ["FORMAT PARQUET", f"COMPRESSION {compression}"]
+    if compression == "zstd":
+        options.append(f"COMPRESSION_LEVEL {level}")
+    if not dictionary:
+        options.append("DICTIONARY_SIZE_LIMIT 0")
+    if row_group_size:
+        options.append(f"ROW_GROUP_SIZE {int(row_group_size)}")
+    return ", ".join(options)
+
+
+def write_parquet(table, path, row_group_size=None, compression=None, level=None, dictionary=None):
+    """Writes an Arrow table as a view file with the same settings as parquet_copy_options()."""
+    compression, level, dictionary = _settings(compression, level, dictionary)
+    pq.write_table(
+        table,
+        path,
+        compression="none" if compression == "uncompressed" else compression,
+        compression_level=level if compression == "zstd" else None,
+        use_dictionary=[c for c in CATEGORICAL_COLUMNS if c in table.column_names] if dictionary else False,
+        row_group_size=row_group_size,
+    )
@@ -22,6 +22,7 @@ sys.path.append(parent_dir)
 
 try:
     from serving_layer.query_engine import ServingLayer
+    from monitoring.metrics import summarize
 except ImportError:
     st.error("Pipeline Core Link Failure: Serving Layer not found in path.")
     st.stop()
@@ -118,7 +119,12 @@ st.markdown("""
     """, unsafe_allow_html=True)
 
 # --- PIPELINE CONTROL PANEL ---
-sl = ServingLayer()
+@st.cache_resource
+def get_serving_layer():
+    # One instance across reruns so its result cache and query statistics accumulate
+    return ServingLayer()
+
+sl = get_serving_layer()
 
 def fetch_telemetry():
     kpis = sl.get_kpis()
@@ -126,6 +132,13 @@ def fetch_telemetry():
     df_raw = sl.get_unified_view()
     return kpis, recent, df_raw
 
+def fmt_seconds(value):
+    if value is None:
+        return "N/A"
+    if value < 1:
+        return f"{value * 1000:,.0f} ms"
+    return f"{value:,.1f} s"
+
 # --- SIDEBAR CONTROL PANEL ---
 with st.sidebar:
     st.markdown("<h1 style='color:#00f3ff; font-family:monospace;'>[ LAMBDA_CORE ]</h1>", unsafe_allow_html=True)
@@ -139,7 +152,17 @@ with st.sidebar:
     st.divider()
     st.caption("CORE STATUS: ONLINE")
     st.progress(100)
-    st.caption("MEMORY LOAD: 14.2 GB / 64 GB")
+
+    st.markdown("### PIPELINE TELEMETRY")
+    ops = summarize()
+    st.caption(f"DATA FRESHNESS: {fmt_seconds(ops.get('lambda_data_freshness_seconds'))}")
+    st.caption(f"EVENT→PROCESSED LAG P95: {fmt_seconds(ops.get('lambda_event_processing_lag_p95_seconds'))}")
+    st.caption(f"EVENTS GENERATED: {ops.get('lambda_events_generated_total', 0):,.0f}")
+    st.caption(f"FILES INGESTED: {ops.get('lambda_files_ingested_total', 0):,.0f}")
+    st.caption(f"ROWS WRITTEN: {ops.get('lambda_rows_written_total', 0):,.0f}")
+    st.caption(f"MICRO-BATCH P95: {fmt_seconds(ops.get('lambda_micro_batch_duration_p95_seconds'))}")
+    st.caption(f"BATCH JOB MEAN: {fmt_seconds(ops.get('lambda_batch_job_duration_mean_seconds'))}")
+    st.caption(f"SERVING QUERY P95: {fmt_seconds(ops.get('lambda_serving_query_duration_p95_seconds'))}")
 
 # --- MAIN HUD CONTENT ---
 st.markdown('<h1 class="glitch-title">LAMBDA DATA PLATFORM</h1>', unsafe_allow_html=True)
@@ -167,6 +190,19 @@ with m4:
         sync_ts = pd.to_datetime(df_all['timestamp']).max().strftime("%H:%M:%S")
     st.metric("LAST DATA POLL", sync_ts, delta="ACTIVE")
 
+# Sketch-backed KPIs: merged hourly sketches, no scan of the unified view
+s1, s2 = st.columns(2)
+
+with s1:
+    st.metric("DISTINCT ACTIVE USERS (≈)", f"{sl.get_distinct_users():,}")
+
+with s2:
+    pct = sl.get_amount_percentiles()
+    if pct["p50"] is None:
+        st.metric("ORDER VALUE P50 / P95", "N/A")
+    else:
+        st.metric("ORDER VALUE P50 / P95", f"${pct['p50']:,.0f} / ${pct['p95']:,.0f}")
+
 # --- ANALYSIS GRID ---
 g1, g2 = st.columns([2, 1])
 
@@ -228,6 +264,18 @@ if not recent.empty:
 else:
     st.warning("STREAM OFFLINE: RECONNECTING TO DATA SOURCES...")
 
+# --- SERVING QUERY STATS ---
+st.markdown("### <span style='color:#00ff9f'>◣</span> SERVING QUERY STATS", unsafe_allow_html=True)
+query_stats = sl.get_query_stats()
+if not query_stats.empty:
+    st.dataframe(
+        query_stats.style.format({
+            "p50_seconds": fmt_seconds, "p99_seconds": fmt_seconds,
+            "avg_rows": "{:,.0f}", "avg_files_scanned": "{:,.1f}",
+        }),
+        use_container_width=True
+    )
+
 # --- FOOTER HUD ---
 st.markdown(f"""
     <div style="background: rgba(0, 243, 255, 0.05); padding: 15px; border-radius: 8px; font-family: monospace; font-size: 0.7rem; border-left: 5px solid #00f3ff; display: flex; justify-content: space-between; align-items: center; margin-top: 3rem;">
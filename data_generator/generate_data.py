@@ -1,11 +1,26 @@
 import os
+import socket
+import sys
 import time
 import random
 import json
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as pa_ipc
+import pyarrow.parquet as pq
+from collections import deque
 from datetime import datetime, timedelta
+import math
 import shutil
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from monitoring.metrics import get_registry
+from event_bus.event_log import EventLog
+from event_bus.schema import STREAM_EVENT_SCHEMA
+
 # Configuration
 env_base = os.getenv("LAMBDA_BASE_DIR")
 if env_base:
@@ -16,6 +31,20 @@ else:
 BATCH_DIR = os.path.join(DATA_DIR, "raw", "batch")
 STREAM_DIR = os.path.join(DATA_DIR, "raw", "stream")
 MASTER_DIR = os.path.join(DATA_DIR, "master")
+USERS_FILE = os.path.join(MASTER_DIR, "users.parquet")
+# Upsert files for the users master, applied in file name (= creation time) order by the batch layer
+USERS_UPDATES_DIR = os.path.join(MASTER_DIR, "users_updates")
+# Stream events remembered for replay into batch history (see WORKLOAD_PROFILES "replay_rate")
+STREAM_LEDGER = os.path.join(DATA_DIR, "raw", "stream_ledger.jsonl")
+
+# Ingestion server endpoint used by stream_to_server (see speed_layer/ingest_server.py)
+INGEST_HOST = os.getenv("LAMBDA_INGEST_HOST", "127.0.0.1")
+INGEST_PORT = int(os.getenv("LAMBDA_INGEST_PORT", "9009"))
+
+# Where simulate_streaming publishes: "files" (raw/stream drop files) or "log" (event log)
+STREAM_SINK = os.getenv("LAMBDA_STREAM_SOURCE", "files")
+# Drop-file format for the "files" sink: "json" (one JSON object per line) or "arrow" (Arrow IPC)
+STREAM_FORMAT = os.getenv("LAMBDA_STREAM_FORMAT", "json")
 
 def ensure_dirs():
     os.makedirs(BATCH_DIR, exist_ok=True)
@@ -23,48 +52,234 @@ def ensure_dirs():
     os.makedirs(MASTER_DIR, exist_ok=True)
 
 # Constants
-NUM_USERS = 1000
+NUM_USERS = int(os.getenv("LAMBDA_NUM_USERS", "1000"))
+# Users are generated and written in slices of this many rows so memory stays flat at any scale
+USERS_CHUNK_ROWS = 1_000_000
 PRODUCTS = ['Laptop', 'Mouse', 'Keyboard', 'Monitor', 'Headset', 'Webcam']
 REGIONS = ['US', 'EU', 'APAC', 'LATAM']
 
-def generate_users():
+USERS_SCHEMA = pa.schema([
+    ("user_id", pa.int64()),
+    ("name", pa.string()),
+    ("region", pa.string()),
+    ("signup_date", pa.date32()),
+])
+
+# Workload shapes for load tests. "uniform" is the historical behaviour; the others exercise the
+# expensive paths: hot-key skew (user_zipf_s), uneven arrivals (arrival, burst_*), the dedup
+# window (duplicate_rate), late / out-of-order stream data (late_rate, late_max_sec) and stream
+# events that reappear in batch history (replay_rate).
+WORKLOAD_PROFILES = {
+    "uniform": {
+        "user_zipf_s": 0.0, "arrival": "steady", "burst_prob": 0.0, "burst_factor": 1,
+        "duplicate_rate": 0.0, "late_rate": 0.0, "late_max_sec": 0, "replay_rate": 0.0,
+    },
+    "skewed": {
+        "user_zipf_s": 1.1, "arrival": "steady", "burst_prob": 0.0, "burst_factor": 1,
+        "duplicate_rate": 0.0, "late_rate": 0.0, "late_max_sec": 0, "replay_rate": 0.0,
+    },
+    "production": {
+        "user_zipf_s": 1.1, "arrival": "diurnal", "burst_prob": 0.05, "burst_factor": 10,
+        "duplicate_rate": 0.02, "late_rate": 0.05, "late_max_sec": 6 * 3600, "replay_rate": 0.5,
+    },
+    "adversarial": {
+        "user_zipf_s": 1.5, "arrival": "bursty", "burst_prob": 0.2, "burst_factor": 50,
+        "duplicate_rate": 0.10, "late_rate": 0.20, "late_max_sec": 3 * 86400, "replay_rate": 1.0,
+    },
+}
+WORKLOAD_PROFILE = os.getenv("LAMBDA_WORKLOAD_PROFILE", "uniform")
+
+# Recently emitted stream events, re-delivered as duplicates by skewed profiles
+_recent_stream_events = deque(maxlen=1000)
+_user_cum_weights = {}
+
+def get_workload_profile(profile=None):
+    name = profile or WORKLOAD_PROFILE
+    if name not in WORKLOAD_PROFILES:
+        raise ValueError(f"Unknown workload profile '{name}', expected one of {sorted(WORKLOAD_PROFILES)}")
+    return WORKLOAD_PROFILES[name]
+
+def sample_user_ids(k, profile=None):
+    """User ids with Zipf(s) popularity (user 1 is the hottest); s=0 is uniform."""
+    s = get_workload_profile(profile)["user_zipf_s"]
+    if s <= 0:
+        return random.choices(range(1, NUM_USERS + 1), k=k)
+    if s not in _user_cum_weights:
+        total, cum = 0.0, []
+        for rank in range(1, NUM_USERS + 1):
+            total += 1.0 / rank ** s
+            cum.append(total)
+        _user_cum_weights[s] = cum
+    return random.choices(range(1, NUM_USERS + 1), cum_weights=_user_cum_weights[s], k=k)
+
+def _diurnal_weight(ts):
+    # Peak around 14:00, trough around 02:00, never fully idle
+    return 0.2 + 0.8 * (1 + math.cos(2 * math.pi * (ts.hour + ts.minute / 60 - 14) / 24)) / 2
+
+def sample_event_times(k, start_date, end_date, profile=None):
+    """Event timestamps between start and end following the profile's arrival pattern."""
+    prof = get_workload_profile(profile)
+    span = int((end_date - start_date).total_seconds())
+    times = []
+    if prof["arrival"] == "bursty":
+        # Bursts happen with probability p at f times the normal rate, i.e. carry pf / (pf + 1 - p)
+        # of the traffic, packed into minutes around a few random instants per day
+        centers = [start_date + timedelta(seconds=random.randint(0, span)) for _ in range(max(1, span // 86400))]
+        pf = prof["burst_prob"] * prof["burst_factor"]
+        burst_share = pf / (pf + 1 - prof["burst_prob"])
+        for _ in range(k):
+            if random.random() < burst_share:
+                t = random.choice(centers) + timedelta(seconds=random.expovariate(1 / 60))
+                times.append(min(t, end_date))
+            else:
+                times.append(start_date + timedelta(seconds=random.randint(0, span)))
+    elif prof["arrival"] == "diurnal":
+        while len(times) < k:
+            t = start_date + timedelta(seconds=random.randint(0, span))
+            if random.random() < _diurnal_weight(t):
+                times.append(t)
+    else:
+        times = [start_date + timedelta(seconds=random.randint(0, span)) for _ in range(k)]
+    return times
+
+def stream_batch_size(profile=None, now=None):
+    """Events in the next micro-batch: 1-5 scaled by time of day and occasional bursts."""
+    prof = get_workload_profile(profile)
+    size = random.randint(1, 5)
+    if prof["arrival"] == "diurnal":
+        size = max(1, round(size * 2 * _diurnal_weight(now or datetime.now())))
+    if random.random() < prof["burst_prob"]:
+        size *= prof["burst_factor"]
+    return size
+
+def _users_table(user_ids, rng, name_suffix=""):
+    """Columnar users slice: names, regions and signup dates are built as whole arrays."""
+    n = len(user_ids)
+    ids = pa.array(user_ids, type=pa.int64())
+    names = pc.binary_join_element_wise("User_", pc.cast(ids, pa.string()), name_suffix, "")
+    regions = pa.array(np.array(REGIONS)[rng.integers(0, len(REGIONS), n)])
+    today = np.datetime64(datetime.now().date(), 'D')
+    signup = today - rng.integers(100, 1001, n).astype('timedelta64[D]')
+    return pa.table([ids, names, regions, pa.array(signup, type=pa.date32())], schema=USERS_SCHEMA)
+
+def _write_parquet_atomic(path, tables):
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with pq.ParquetWriter(tmp_path, USERS_SCHEMA) as writer:
+        for table in tables:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def generate_users(num_users=None):
+    """
+    Writes the users master as typed Parquet (users.parquet). A full regeneration supersedes
+    any pending upsert files, so they are cleared.
+    """
     ensure_dirs()
-    print("Generating Users Master Data...")
-    users = []
-    for i in range(1, NUM_USERS + 1):
-        users.append({
-            "user_id": i,
-            "name": f"User_{i}",
-            "region": random.choice(REGIONS),
-            "signup_date": (datetime.now() - timedelta(days=random.randint(100, 1000))).strftime("%Y-%m-%d")
-        })
-    df = pd.DataFrame(users)
-    df.to_csv(os.path.join(MASTER_DIR, "users.csv"), index=False)
+    num_users = num_users or NUM_USERS
+    print(f"Generating Users Master Data ({num_users} users)...")
+    rng = np.random.default_rng()
+    chunks = (
+        _users_table(np.arange(lo, min(lo + USERS_CHUNK_ROWS, num_users + 1)), rng)
+        for lo in range(1, num_users + 1, USERS_CHUNK_ROWS)
+    )
+    _write_parquet_atomic(USERS_FILE, chunks)
+    if os.path.isdir(USERS_UPDATES_DIR):
+        shutil.rmtree(USERS_UPDATES_DIR)
     print("Users Generated.")
 
-def generate_batch_history(num_records=10000):
+def _max_user_id():
+    """Largest user_id in the users master and its upsert files (0 when there are none)."""
+    paths = [USERS_FILE] if os.path.exists(USERS_FILE) else []
+    if os.path.isdir(USERS_UPDATES_DIR):
+        paths += [os.path.join(USERS_UPDATES_DIR, f) for f in os.listdir(USERS_UPDATES_DIR) if f.endswith(".parquet")]
+    top = 0
+    for path in paths:
+        meta = pq.ParquetFile(path).metadata
+        stats = [meta.row_group(i).column(0).statistics for i in range(meta.num_row_groups)]
+        if all(st is not None and st.has_min_max for st in stats):
+            # user_id is the first column; row group statistics avoid reading it
+            top = max([top] + [st.max for st in stats])
+        else:
+            top = max(top, pc.max(pq.read_table(path, columns=["user_id"])["user_id"]).as_py() or 0)
+    return top
+
+def generate_user_updates(num_changes=100, user_ids=None, new_user_rate=0.1):
+    """
+    Writes one upsert file of changed users (new region and renamed) to master/users_updates/,
+    plus about `new_user_rate` brand new users. Returns the file path.
+    """
+    os.makedirs(USERS_UPDATES_DIR, exist_ok=True)
+    rng = np.random.default_rng()
+    if user_ids is None:
+        user_ids = rng.choice(np.arange(1, NUM_USERS + 1), size=min(num_changes, NUM_USERS), replace=False)
+    # New users continue after every id already issued, by the master or an earlier upsert file
+    first_new = _max_user_id() + 1
+    new_ids = np.arange(first_new, first_new + int(len(user_ids) * new_user_rate))
+    version = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    table = _users_table(np.concatenate([np.asarray(user_ids, dtype=np.int64), new_ids]), rng, name_suffix=f"_v{version}")
+    path = os.path.join(USERS_UPDATES_DIR, f"users_update_{version}.parquet")
+    _write_parquet_atomic(path, [table])
+    print(f"Wrote {table.num_rows} user upserts to {path}")
+    return path
+
+def generate_batch_history(num_records=10000, profile=None):
     ensure_dirs()
+    prof = get_workload_profile(profile)
     print(f"Generating {num_records} historical records for Batch Layer...")
     data = []
     end_date = datetime.now() - timedelta(days=1) # History ends yesterday
     start_date = end_date - timedelta(days=30)
     
-    for _ in range(num_records):
-        tx_time = start_date + timedelta(seconds=random.randint(0, int((end_date - start_date).total_seconds())))
+    tx_times = sample_event_times(num_records, start_date, end_date, profile)
+    user_ids = sample_user_ids(num_records, profile)
+    for tx_time, user_id in zip(tx_times, user_ids):
         data.append({
             "transaction_id": f"tx_{random.randint(100000, 999999)}_{random.randint(100000, 999999)}",
-            "user_id": random.randint(1, NUM_USERS),
+            "user_id": user_id,
             "product": random.choice(PRODUCTS),
             "amount": round(random.uniform(50, 2000), 2),
             "timestamp": tx_time.strftime("%Y-%m-%d %H:%M:%S"),
             "status": "COMPLETED"
         })
+
+    # Re-deliveries of the same transaction id; half carry a later correction the dedup must keep
+    for original in random.choices(data, k=int(num_records * prof["duplicate_rate"])) if data else []:
+        dup = dict(original)
+        if random.random() < 0.5:
+            corrected = datetime.strptime(original["timestamp"], "%Y-%m-%d %H:%M:%S") + timedelta(seconds=random.randint(1, 3600))
+            dup["timestamp"] = corrected.strftime("%Y-%m-%d %H:%M:%S")
+            dup["amount"] = round(random.uniform(50, 2000), 2)
+        data.append(dup)
+    random.shuffle(data)
     
     df = pd.DataFrame(data)
     # Save as JSON for "raw" feel, or CSV. Let's use JSON per line for big data feel (simulating dump)
     df.to_json(os.path.join(BATCH_DIR, "history.json"), orient="records", lines=True)
+    replayed = replay_stream_ledger(profile)
+    metrics = get_registry("generator")
+    metrics.inc("lambda_events_generated_total", len(data) + replayed, source="batch")
+    metrics.flush()
     print("Batch History Generated.")
 
+def replay_stream_ledger(profile=None):
+    """
+    Moves stream events recorded in the ledger into batch history as COMPLETED records with the
+    same transaction ids (the batch re-delivery of data the speed layer already served).
+    Returns the number of replayed events.
+    """
+    prof = get_workload_profile(profile)
+    if prof["replay_rate"] <= 0 or not os.path.exists(STREAM_LEDGER):
+        return 0
+    with open(STREAM_LEDGER, 'r') as f:
+        ledger = [json.loads(line) for line in f if line.strip()]
+    replayed = [dict(e, status="COMPLETED") for e in ledger if random.random() < prof["replay_rate"]]
+    if replayed:
+        path = os.path.join(BATCH_DIR, f"replayed_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.json")
+        pd.DataFrame(replayed).to_json(path, orient="records", lines=True)
+    os.remove(STREAM_LEDGER)
+    print(f"Replayed {len(replayed)} stream events into batch history.")
+    return len(replayed)
+
 def generate_stream_event():
     """Generates a single event representing real-time data"""
     tx_time = datetime.now()
@@ -78,28 +293,153 @@ def generate_stream_event():
     }
     return event
 
-def simulate_streaming(interval_sec=1, duration_sec=10):
+def generate_stream_events(num_events, profile=None):
+    """
+    Generates a micro-batch shaped by a workload profile: skewed users, late (back-dated, hence
+    out-of-order) events and re-deliveries of recently emitted events with the same transaction id.
+    """
+    prof = get_workload_profile(profile)
+    now = datetime.now()
+    events = []
+    for user_id in sample_user_ids(num_events, profile):
+        if _recent_stream_events and random.random() < prof["duplicate_rate"]:
+            events.append(dict(random.choice(_recent_stream_events)))
+            continue
+        event = generate_stream_event()
+        event["user_id"] = user_id
+        if random.random() < prof["late_rate"]:
+            late = now - timedelta(seconds=random.randint(1, prof["late_max_sec"]))
+            event["timestamp"] = late.strftime("%Y-%m-%d %H:%M:%S")
+        _recent_stream_events.append(event)
+        events.append(event)
+
+    if prof["replay_rate"] > 0 and events:
+        os.makedirs(os.path.dirname(STREAM_LEDGER), exist_ok=True)
+        with open(STREAM_LEDGER, 'a') as f:
+            for e in events:
+                f.write(json.dumps(e) + "\n")
+    return events
+
+def generate_stream_batch(num_events, profile=None):
+    """Generates a micro-batch column by column as an Arrow table (no per-event dicts)."""
+    if get_workload_profile(profile) is not WORKLOAD_PROFILES["uniform"]:
+        events = generate_stream_events(num_events, profile)
+        return pa.table({
+            "transaction_id": [e["transaction_id"] for e in events],
+            "user_id": [e["user_id"] for e in events],
+            "product": [e["product"] for e in events],
+            "amount": [e["amount"] for e in events],
+            "timestamp": [datetime.strptime(e["timestamp"], "%Y-%m-%d %H:%M:%S") for e in events],
+            "status": [e["status"] for e in events],
+        }, schema=STREAM_EVENT_SCHEMA)
+    tx_time = datetime.now().replace(microsecond=0)
+    return pa.table({
+        "transaction_id": [f"stream_{n}" for n in random.choices(range(100000, 1000000), k=num_events)],
+        "user_id": random.choices(range(1, NUM_USERS + 1), k=num_events),
+        "product": random.choices(PRODUCTS, k=num_events),
+        "amount": [round(random.uniform(50, 2000), 2) for _ in range(num_events)],
+        "timestamp": [tx_time] * num_events,
+        "status": ["PENDING"] * num_events,
+    }, schema=STREAM_EVENT_SCHEMA)
+
+def write_stream_file(filename, events, fmt="json"):
+    """
+    Writes one micro-batch drop file into the stream directory. `events` is a list of dicts
+    for JSON, or an Arrow table for the Arrow IPC format. Written under a temp name and renamed
+    so the speed layer never lists a half-written file.
+    """
+    filepath = os.path.join(STREAM_DIR, filename)
+    if fmt == "arrow":
+        with pa.OSFile(filepath + ".tmp", 'wb') as sink:
+            with pa_ipc.new_file(sink, events.schema) as writer:
+                writer.write_table(events)
+    else:
+        with open(filepath + ".tmp", 'w') as f:
+            for e in events:
+                f.write(json.dumps(e) + "\n")
+    os.replace(filepath + ".tmp", filepath)
+    return filepath
+
+def simulate_streaming(interval_sec=1, duration_sec=10, sink=None, fmt=None, profile=None):
     ensure_dirs()
+    get_workload_profile(profile)
+    sink = sink or STREAM_SINK
+    fmt = fmt or STREAM_FORMAT
+    if sink not in ("files", "log"):
+        raise ValueError(f"Unknown stream sink '{sink}', expected 'files' or 'log'")
+    if fmt not in ("json", "arrow"):
+        raise ValueError(f"Unknown stream format '{fmt}', expected 'json' or 'arrow'")
     print(f"Simulating streaming for {duration_sec} seconds...")
+    metrics = get_registry("generator")
+    event_log = EventLog() if sink == "log" else None
     start_time = time.time()
     batch_id = 0
     while time.time() - start_time < duration_sec:
         # Generate a micro-batch of events
-        events = [generate_stream_event() for _ in range(random.randint(1, 5))]
-        
-        # Write to stream directory as a file (simulating file-drop or Kafka topic partition dump)
-        filename = f"events_{batch_id}_{int(time.time())}.json"
-        filepath = os.path.join(STREAM_DIR, filename)
+        num_events = stream_batch_size(profile)
         
-        with open(filepath, 'w') as f:
-            for e in events:
-                f.write(json.dumps(e) + "\n")
+        if event_log is not None:
+            # Produce into the partitioned event log (local Kafka stand-in)
+            event_log.append(generate_stream_events(num_events, profile))
+            target = f"event log topic '{event_log.topic}'"
+        else:
+            # Write to stream directory as a file (simulating file-drop or Kafka topic partition dump)
+            if fmt == "arrow":
+                events = generate_stream_batch(num_events, profile)
+            else:
+                events = generate_stream_events(num_events, profile)
+            target = f"events_{batch_id}_{int(time.time())}.{fmt}"
+            write_stream_file(target, events, fmt)
         
-        print(f"Streamed {len(events)} events to {filename}")
+        metrics.inc("lambda_events_generated_total", num_events, source="stream")
+        metrics.flush()
+        print(f"Streamed {num_events} events to {target}")
         batch_id += 1
         time.sleep(interval_sec)
 
+def stream_to_server(duration_sec=10, events_per_sec=1000, host=INGEST_HOST, port=INGEST_PORT, unix_path=None, profile=None):
+    """Load client: sends generated events as NDJSON to the ingest server at a target rate."""
+    if unix_path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(unix_path)
+    else:
+        sock = socket.create_connection((host, port))
+    metrics = get_registry("generator")
+    # Send in ~10 ms slices so the rate stays smooth without a syscall per event
+    slice_sec = 0.01
+    per_slice = max(1, int(events_per_sec * slice_sec))
+    sent = 0
+    start_time = time.time()
+    try:
+        while time.time() - start_time < duration_sec:
+            payload = "".join(json.dumps(e) + "\n" for e in generate_stream_events(per_slice, profile))
+            sock.sendall(payload.encode("utf-8"))
+            sent += per_slice
+            ahead = sent / events_per_sec - (time.time() - start_time)
+            if ahead > 0:
+                time.sleep(ahead)
+    finally:
+        sock.close()
+    metrics.inc("lambda_events_generated_total", sent, source="ingest")
+    metrics.flush()
+    print(f"Sent {sent} events to the ingest server in {time.time() - start_time:.1f}s")
+    return sent
+
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Synthetic data generator")
+    parser.add_argument("--workload", choices=sorted(WORKLOAD_PROFILES), default=WORKLOAD_PROFILE,
+                        help="Workload shape for generated history and stream events")
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=NUM_USERS)
+    parser.add_argument("--user-updates", type=int, default=0, metavar="N",
+                        help="Only write an upsert file changing N existing users")
+    args = parser.parse_args()
+    # History and upserts draw user ids from 1..NUM_USERS
+    NUM_USERS = args.users
+    if args.user_updates:
+        generate_user_updates(args.user_updates)
+        sys.exit(0)
     generate_users()
-    generate_batch_history()
+    generate_batch_history(args.records, profile=args.workload)
     # Streaming is usually called separately or via a flag, but for setup we might just init headers
@@ -0,0 +1,301 @@
+import bisect
+import json
+import os
+import struct
+import time
+import zlib
+
+# Path Setup
+env_base = os.getenv("LAMBDA_BASE_DIR")
+if env_base:
+    BASE_DIR = env_base
+else:
+    BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_DIR = os.path.join(BASE_DIR, "data")
+EVENT_LOG_DIR = os.path.join(DATA_DIR, "event_log")
+
+DEFAULT_TOPIC = "transactions"
+DEFAULT_PARTITIONS = 4
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+INDEX_INTERVAL_RECORDS = 256
+
+# Index entry: offset relative to the segment base, byte position of that record in the .log file
+INDEX_ENTRY = struct.Struct("<IQ")
+
+
+def _segment_name(base_offset):
+    return f"{base_offset:020d}"
+
+
+class _Partition:
+    """One partition directory: <base>.log segments (NDJSON) with sparse <base>.index files."""
+
+    def __init__(self, path, segment_max_bytes, index_interval):
+        self.path = path
+        self.segment_max_bytes = segment_max_bytes
+        self.index_interval = index_interval
+        os.makedirs(path, exist_ok=True)
+        self._next_offset = None
+
+    def segments(self):
+        return sorted(int(f[:-4]) for f in os.listdir(self.path) if f.endswith('.log'))
+
+    def _log_path(self, base):
+        return os.path.join(self.path, _segment_name(base) + ".log")
+
+    def _index_path(self, base):
+        return os.path.join(self.path, _segment_name(base) + ".index")
+
+    def _read_index(self, base):
+        path = self._index_path(base)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            raw = f.read()
+        usable = len(raw) - len(raw) % INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(raw, i) for i in range(0, usable, INDEX_ENTRY.size)]
+
+    def _seek_position(self, base, relative_offset):
+        """Nearest indexed (relative offset, byte position) at or before `relative_offset`."""
+        entries = self._read_index(base)
+        i = bisect.bisect_right([e[0] for e in entries], relative_offset) - 1
+        return entries[i] if i >= 0 else (0, 0)
+
+    def _count_records(self, base):
+        """Records in a segment, resuming from its last index entry instead of scanning it all."""
+        rel, pos = self._seek_position(base, 2 ** 32 - 1)
+        with open(self._log_path(base), 'rb') as f:
+            f.seek(pos)
+            return rel + f.read().count(b"\n")
+
+    def earliest_offset(self):
+        segments = self.segments()
+        return segments[0] if segments else 0
+
+    def end_offset(self):
+        segments = self.segments()
+        return segments[-1] + self._count_records(segments[-1]) if segments else 0
+
+    def _truncate_torn_tail(self, base):
+        """
+        Cuts a partial record left by a crashed producer off the end of segment `base`, so the
+        next append starts on a record boundary instead of completing the torn line. A partial
+        index entry is cut too; index entries are written after their records, so none point past the cut.
+        """
+        _, pos = self._seek_position(base, 2 ** 32 - 1)
+        log_path = self._log_path(base)
+        with open(log_path, 'rb+') as f:
+            f.seek(pos)
+            tail = f.read()
+            end = pos + tail.rfind(b"\n") + 1
+            if end < pos + len(tail):
+                f.truncate(end)
+                print(f"Truncated {pos + len(tail) - end} bytes of a torn record from {log_path}")
+        index_path = self._index_path(base)
+        if os.path.exists(index_path):
+            size = os.path.getsize(index_path)
+            if size % INDEX_ENTRY.size:
+                with open(index_path, 'rb+') as f:
+                    f.truncate(size - size % INDEX_ENTRY.size)
+
+    def append(self, lines):
+        """Appends encoded records (bytes, newline-terminated) and returns the first assigned offset."""
+        if self._next_offset is None:
+            # Only the (single) producer caches the end offset and repairs the active segment;
+            # readers always rescan and stop at a torn record
+            segments = self.segments()
+            if segments:
+                self._truncate_torn_tail(segments[-1])
+            self._next_offset = self.end_offset()
+        first_offset = self._next_offset
+        segments = self.segments()
+        base = segments[-1] if segments else first_offset
+        log_path = self._log_path(base)
+        size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+
+        i = 0
+        while i < len(lines):
+            if size >= self.segment_max_bytes:
+                base, size = self._next_offset, 0
+                log_path = self._log_path(base)
+            chunk, index_entries = [], []
+            while i < len(lines) and size < self.segment_max_bytes:
+                relative = self._next_offset - base
+                if relative % self.index_interval == 0:
+                    index_entries.append(INDEX_ENTRY.pack(relative, size))
+                chunk.append(lines[i])
+                size += len(lines[i])
+                self._next_offset += 1
+                i += 1
+            # One write per segment keeps appends of thousands of records cheap
+            with open(log_path, 'ab') as f:
+                f.write(b"".join(chunk))
+            if index_entries:
+                with open(self._index_path(base), 'ab') as f:
+                    f.write(b"".join(index_entries))
+        return first_offset
+
+    def read(self, offset, max_records):
+        """Returns (newline-joined record bytes, record count, next offset) starting at `offset`."""
+        segments = self.segments()
+        if not segments:
+            return b"", 0, offset
+        offset = max(offset, segments[0])  # Retention removed older records: resume at the earliest
+        chunks, count = [], 0
+        seg_idx = bisect.bisect_right(segments, offset) - 1
+        while seg_idx < len(segments) and count < max_records:
+            base = segments[seg_idx]
+            rel, pos = self._seek_position(base, offset - base)
+            with open(self._log_path(base), 'rb') as f:
+                f.seek(pos)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Torn write from a crashed producer; never expose partial records
+                    if rel >= offset - base:
+                        chunks.append(line)
+                        count += 1
+                        offset += 1
+                        if count >= max_records:
+                            break
+                    rel += 1
+            seg_idx += 1
+        return b"".join(chunks), count, offset
+
+    def delete_segment(self, base):
+        for path in (self._log_path(base), self._index_path(base)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class EventLog:
+    """
+    Local, partitioned, append-only event log standing in for a Kafka topic.
+    Records are JSON lines routed to a partition by a stable hash of `key`; each partition is a
+    sequence of segment files named after their base offset, with a sparse binary index so
+    consumers can seek to any offset without scanning. Consumer groups store their next offset
+    per partition under consumers/<group>.json. A partition must have a single producer.
+    """
+
+    def __init__(self, topic=DEFAULT_TOPIC, root=EVENT_LOG_DIR, num_partitions=None,
+                 segment_max_bytes=SEGMENT_MAX_BYTES, index_interval=INDEX_INTERVAL_RECORDS,
+                 retention_segments=None, retention_seconds=None):
+        self.topic = topic
+        self.path = os.path.join(root, topic)
+        self.retention_segments = retention_segments
+        self.retention_seconds = retention_seconds
+        os.makedirs(os.path.join(self.path, "consumers"), exist_ok=True)
+
+        meta_path = os.path.join(self.path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                stored = json.load(f)["num_partitions"]
+            if num_partitions is not None and num_partitions != stored:
+                raise ValueError(f"Topic '{topic}' already has {stored} partitions, got {num_partitions}")
+            num_partitions = stored
+        else:
+            num_partitions = num_partitions or DEFAULT_PARTITIONS
+            with open(meta_path, 'w') as f:
+                json.dump({"num_partitions": num_partitions}, f)
+
+        self.num_partitions = num_partitions
+        self.partitions = [
+            _Partition(os.path.join(self.path, f"partition-{p}"), segment_max_bytes, index_interval)
+            for p in range(num_partitions)
+        ]
+
+    def partition_for(self, key):
+        # crc32 is stable across processes, unlike hash()
+        return zlib.crc32(str(key).encode("utf-8")) % self.num_partitions
+
+    def append(self, events, key="user_id"):
+        """Appends a batch of event dicts, grouped per partition into one write each."""
+        by_partition = {}
+        for e in events:
+            line = (json.dumps(e, separators=(",", ":")) + "\n").encode("utf-8")
+            by_partition.setdefault(self.partition_for(e.get(key)), []).append(line)
+        for p, lines in by_partition.items():
+            self.partitions[p].append(lines)
+        return {p: len(lines) for p, lines in by_partition.items()}
+
+    def read(self, partition, offset, max_records=5000):
+        return self.partitions[partition].read(offset, max_records)
+
+    def end_offsets(self):
+        return {p: part.end_offset() for p, part in enumerate(self.partitions)}
+
+    def fingerprint(self):
+        """Cheap change marker (active segment and its size per partition) for polling consumers."""
+        state = []
+        for part in self.partitions:
+            segments = part.segments()
+            if segments:
+                state.append((segments[-1], os.path.getsize(part._log_path(segments[-1]))))
+            else:
+                state.append(None)
+        return tuple(state)
+
+    # --- Consumer groups ---
+
+    def _group_path(self, group):
+        return os.path.join(self.path, "consumers", f"{group}.json")
+
+    def committed(self, group):
+        path = self._group_path(group)
+        offsets = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                offsets = {int(p): o for p, o in json.load(f).items()}
+        return {p: offsets.get(p, self.partitions[p].earliest_offset()) for p in range(self.num_partitions)}
+
+    def commit(self, group, offsets):
+        merged = self.committed(group)
+        merged.update(offsets)
+        path = self._group_path(group)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({str(p): o for p, o in merged.items()}, f)
+        os.replace(tmp_path, path)
+
+    def poll(self, group, max_records=5000):
+        """Reads up to `max_records` per partition from the group's committed offsets (not committed)."""
+        batches = {}
+        for p, offset in self.committed(group).items():
+            payload, count, next_offset = self.read(p, offset, max_records)
+            if count:
+                batches[p] = (payload, count, offset, next_offset)
+        return batches
+
+    # --- Retention ---
+
+    def enforce_retention(self, protect_consumers=True):
+        """
+        Deletes closed segments beyond `retention_segments` per partition or older than
+        `retention_seconds`. With `protect_consumers`, segments some group has not yet
+        consumed are kept. Returns the number of segments removed.
+        """
+        if self.retention_segments is None and self.retention_seconds is None:
+            return 0
+        floors = {p: None for p in range(self.num_partitions)}
+        if protect_consumers:
+            for file_name in os.listdir(os.path.join(self.path, "consumers")):
+                if file_name.endswith('.json'):
+                    for p, o in self.committed(file_name[:-5]).items():
+                        floors[p] = o if floors[p] is None else min(floors[p], o)
+
+        removed = 0
+        now = time.time()
+        for p, part in enumerate(self.partitions):
+            segments = part.segments()
+            for i, base in enumerate(segments[:-1]):  # The active segment is never deleted
+                next_base = segments[i + 1]
+                too_many = self.retention_segments is not None and len(segments) - i > self.retention_segments
+                too_old = (self.retention_seconds is not None
+                           and now - os.path.getmtime(part._log_path(base)) > self.retention_seconds)
+                if not (too_many or too_old):
+                    break
+                if floors[p] is not None and floors[p] < next_base:
+                    break
+                part.delete_segment(base)
+                removed += 1
+        return removed
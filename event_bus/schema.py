@@ -0,0 +1,12 @@
+import pyarrow as pa
+
+# Contract for events on the stream bus. Matches what read_json_auto infers for the JSON
+# drop files, so speed view files from every format and source stay union-compatible.
+STREAM_EVENT_SCHEMA = pa.schema([
+    ("transaction_id", pa.string()),
+    ("user_id", pa.int64()),
+    ("product", pa.string()),
+    ("amount", pa.float64()),
+    ("timestamp", pa.timestamp("us")),
+    ("status", pa.string()),
+])
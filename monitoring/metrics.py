@@ -0,0 +1,312 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Path Setup
+env_base = os.getenv("LAMBDA_BASE_DIR")
+if env_base:
+    BASE_DIR = env_base
+else:
+    BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_DIR = os.path.join(BASE_DIR, "data")
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")
+PROM_FILE = os.path.join(METRICS_DIR, "metrics.prom")
+
+# Latency buckets (seconds) shared by every histogram on the platform
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+METRIC_HELP = {
+    "lambda_events_generated_total": ("counter", "Events emitted by the data generator."),
+    "lambda_files_ingested_total": ("counter", "Raw input files consumed by a layer."),
+    "lambda_rows_written_total": ("counter", "Rows written to batch or speed views."),
+    "lambda_micro_batch_duration_seconds": ("histogram", "Wall time of one speed layer micro-batch."),
+    "lambda_batch_job_duration_seconds": ("histogram", "Wall time of one batch layer job."),
+    "lambda_serving_query_duration_seconds": ("histogram", "Latency of serving layer queries."),
+    "lambda_event_processing_lag_seconds": ("histogram", "Worst event->processed lag per ingested micro-batch file."),
+    "lambda_ingest_buffer_wait_seconds": ("histogram", "Time the oldest buffered event waited before an ingest server flush."),
+    "lambda_data_freshness_seconds": ("gauge", "Age of the newest queryable event at query time."),
+    "lambda_last_run_timestamp_seconds": ("gauge", "Unix time of the last completed job run."),
+}
+
+
+# Set from the registry name when rendering; a caller-supplied one would duplicate the job's series
+RESERVED_LABELS = ("job",)
+
+
+def _series_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _checked_series_key(labels):
+    reserved = [k for k in RESERVED_LABELS if k in labels]
+    if reserved:
+        raise ValueError(f"Label(s) {reserved} are reserved; the job label comes from the registry name")
+    return _series_key(labels)
+
+
+class MetricsRegistry:
+    """
+    Process-local counters, gauges and histograms for one job (generator, batch, speed, serving).
+    Layers run as separate processes, so each job persists its own snapshot under
+    data/metrics/<job>.json and `flush()` re-renders the combined Prometheus text file.
+    Snapshots are reloaded on start-up so counters keep accumulating across job runs.
+    """
+
+    def __init__(self, job, buckets=DEFAULT_BUCKETS):
+        self.job = job
+        self.buckets = tuple(buckets)
+        self.snapshot_path = os.path.join(METRICS_DIR, f"{job}.json")
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            return
+        for kind in ("counters", "gauges", "histograms"):
+            # Series recorded before reserved labels were rejected are dropped, not carried forward
+            snap[kind] = [s for s in snap.get(kind, []) if not any(k in s["labels"] for k in RESERVED_LABELS)]
+        for s in snap.get("counters", []):
+            self._counters[(s["name"], _series_key(s["labels"]))] = s["value"]
+        for s in snap.get("gauges", []):
+            self._gauges[(s["name"], _series_key(s["labels"]))] = s["value"]
+        for s in snap.get("histograms", []):
+            if tuple(s["buckets"]) != self.buckets:
+                continue  # Bucket layout changed, start the series afresh
+            self._histograms[(s["name"], _series_key(s["labels"]))] = {
+                "counts": s["counts"], "sum": s["sum"], "count": s["count"]
+            }
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _checked_series_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, _checked_series_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _checked_series_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._histograms[key] = hist
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist["counts"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "job": self.job,
+                "updated_at": time.time(),
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self._counters.items()],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self._gauges.items()],
+                "histograms": [
+                    {"name": n, "labels": dict(l), "buckets": list(self.buckets), **h}
+                    for (n, l), h in self._histograms.items()
+                ],
+            }
+
+    def flush(self):
+        """Persists this job's snapshot and re-renders the shared Prometheus text file."""
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        snap = self.snapshot()
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snap, f)
+        os.replace(tmp_path, self.snapshot_path)
+        write_prometheus_file()
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(job):
+    with _registries_lock:
+        if job not in _registries:
+            _registries[job] = MetricsRegistry(job)
+        return _registries[job]
+
+
+def _load_snapshots():
+    if not os.path.isdir(METRICS_DIR):
+        return []
+    snaps = []
+    for file_name in sorted(os.listdir(METRICS_DIR)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, file_name), 'r') as f:
+                snaps.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # Snapshot is being replaced, pick it up on the next render
+    return snaps
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+    return "{" + body + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def render_prometheus():
+    """Renders every job snapshot in the Prometheus text exposition format."""
+    families = {}
+    for snap in _load_snapshots():
+        job = snap.get("job", "unknown")
+        for kind in ("counters", "gauges", "histograms"):
+            for s in snap.get(kind, []):
+                families.setdefault(s["name"], []).append((job, kind, s))
+
+    lines = []
+    for name in sorted(families):
+        metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for job, kind, s in families[name]:
+            if any(k in s["labels"] for k in RESERVED_LABELS):
+                # Written before labels were checked: rendering it would clash with the job's own series
+                print(f"Skipping metric series {name}{_format_labels(s['labels'])} of job '{job}': reserved label")
+                continue
+            labels = dict(s["labels"], job=job)
+            if kind != "histograms":
+                lines.append(f"{name}{_format_labels(labels)} {s['value']}")
+                continue
+            for bound, count in zip(s["buckets"], s["counts"]):
+                lines.append(f"{name}_bucket{_format_labels(dict(labels, le=_format_bound(bound)))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(dict(labels, le='+Inf'))} {s['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {s['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {s['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path=PROM_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+    return path
+
+
+def histogram_quantile(q, buckets, counts, total):
+    """Linear interpolation inside the cumulative bucket that holds quantile q (as PromQL does)."""
+    if total == 0:
+        return None
+    rank = q * total
+    prev_bound, prev_count = 0.0, 0
+    for bound, count in zip(buckets, counts):
+        if count >= rank:
+            if count == prev_count:
+                return bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / (count - prev_count)
+        prev_bound, prev_count = bound, count
+    return buckets[-1]
+
+
+def summarize():
+    """
+    Flattens all job snapshots into headline numbers for the dashboard:
+    counters summed across label sets, gauges as-is and histograms as count/mean/p95.
+    """
+    summary = {}
+    merged_hists = {}
+    for snap in _load_snapshots():
+        for s in snap.get("counters", []):
+            summary[s["name"]] = summary.get(s["name"], 0) + s["value"]
+        for s in snap.get("gauges", []):
+            summary[s["name"]] = max(summary.get(s["name"], s["value"]), s["value"])
+        for s in snap.get("histograms", []):
+            hist = merged_hists.setdefault(s["name"], {"buckets": s["buckets"], "counts": [0] * len(s["buckets"]), "sum": 0.0, "count": 0})
+            if hist["buckets"] != s["buckets"]:
+                continue
+            hist["counts"] = [a + b for a, b in zip(hist["counts"], s["counts"])]
+            hist["sum"] += s["sum"]
+            hist["count"] += s["count"]
+
+    for name, hist in merged_hists.items():
+        base = name[:-len("_seconds")] if name.endswith("_seconds") else name
+        summary[f"{base}_count"] = hist["count"]
+        summary[f"{base}_mean_seconds"] = hist["sum"] / hist["count"] if hist["count"] else None
+        summary[f"{base}_p95_seconds"] = histogram_quantile(0.95, hist["buckets"], hist["counts"], hist["count"])
+    return summary
+
+
+def event_lag_seconds(event_time, now=None):
+    """Seconds between an event timestamp (naive local time, as generated) and now."""
+    if event_time is None:
+        return None
+    now = now or datetime.now()
+    return max((now - event_time).total_seconds(), 0.0)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(host="127.0.0.1", port=9108):
+    """Starts a background /metrics endpoint for Prometheus scraping. Returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Metrics endpoint listening on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Lambda Platform metrics exporter")
+    parser.add_argument("--port", type=int, default=9108)
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+    serve_metrics(args.host, args.port)
+    try:
+        while True:
+            write_prometheus_file()
+            time.sleep(15)
+    except KeyboardInterrupt:
+        print("Stopping metrics exporter.")
@@ -0,0 +1,199 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Path Setup
+env_base = os.getenv("LAMBDA_BASE_DIR")
+if env_base:
+    BASE_DIR = env_base
+else:
+    BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATA_DIR = os.path.join(BASE_DIR, "data")
+PROFILES_DIR = os.path.join(DATA_DIR, "profiles")
+
+# Profiling is opt-in: it adds a JSON profile write per query and a report per run
+PROFILE_ENABLED = os.getenv("LAMBDA_PROFILE", "0").lower() in ("1", "true", "yes")
+
+
+def operator_rows(node, depth=0, out=None):
+    """Flattens a DuckDB JSON profile tree into one row per physical operator."""
+    if out is None:
+        out = []
+    for child in node.get("children", []):
+        name = child.get("operator_name", child.get("name", "UNKNOWN"))
+        out.append({
+            "operator": name.strip(),
+            "depth": depth,
+            "seconds": child.get("operator_timing", child.get("timing", 0.0)),
+            "rows": child.get("operator_cardinality", child.get("cardinality", 0)),
+        })
+        operator_rows(child, depth + 1, out)
+    return out
+
+
+@contextmanager
+def json_profiling(con, profile_path):
+    """
+    Enables DuckDB's JSON profiling on `con` for the block. Afterwards the yielded dict's
+    "profile" holds the profile tree of the last query run in it, or None when that query
+    had no physical plan (DDL, pragmas).
+    """
+    profile_path = profile_path.replace('\\', '/')
+    os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+    if os.path.exists(profile_path):
+        os.remove(profile_path)
+    result = {"profile": None}
+    con.execute("PRAGMA enable_profiling='json'")
+    con.execute(f"PRAGMA profiling_output='{profile_path}'")
+    try:
+        yield result
+    finally:
+        con.execute("PRAGMA disable_profiling")
+        if os.path.exists(profile_path):
+            with open(profile_path, 'r') as f:
+                result["profile"] = json.load(f)
+            os.remove(profile_path)
+
+
+class Profiler:
+    """
+    Records wall time and row counts per named stage of a job and, for every query run
+    through `execute()`, DuckDB's JSON profile (the same operator tree EXPLAIN ANALYZE prints).
+    When disabled the stage/execute helpers cost nothing beyond running the query.
+    """
+
+    def __init__(self, job, enabled=None):
+        self.job = job
+        self.enabled = PROFILE_ENABLED if enabled is None else enabled
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self.stages = []
+        self._current = None
+        self._query_profile_path = os.path.join(PROFILES_DIR, f".{job}_{os.getpid()}_query.json")
+
+    @contextmanager
+    def stage(self, name):
+        record = {"stage": name, "rows": None, "wall_seconds": None, "queries": []}
+        previous, self._current = self._current, record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - start
+            self._current = previous
+            if self.enabled:
+                self.stages.append(record)
+
+    def execute(self, con, sql):
+        """Runs `sql` on `con` and returns all result rows, capturing its profile when enabled."""
+        if not self.enabled:
+            return con.execute(sql).fetchall()
+
+        with json_profiling(con, self._query_profile_path) as captured:
+            start = time.perf_counter()
+            rows = con.execute(sql).fetchall()
+            elapsed = time.perf_counter() - start
+
+        entry = {"sql": " ".join(sql.split()), "wall_seconds": elapsed, "profile": captured["profile"], "operators": []}
+        # DDL (views, pragmas) produces no profile, only queries with a physical plan do
+        if entry["profile"] is not None:
+            entry["operators"] = operator_rows(entry["profile"])
+        if self._current is not None:
+            self._current["queries"].append(entry)
+        return rows
+
+    def write_report(self):
+        """Writes data/profiles/<job>/<timestamp>.json and returns its path (None when disabled)."""
+        if not self.enabled:
+            return None
+        report_dir = os.path.join(PROFILES_DIR, self.job)
+        os.makedirs(report_dir, exist_ok=True)
+        report = {
+            "job": self.job,
+            "started_at": self.started_at.isoformat(),
+            # Elapsed time of the run: stages of parallel workers overlap, so their sum would overstate it
+            "total_seconds": time.perf_counter() - self._started,
+            "stages": self.stages,
+        }
+        path = os.path.join(report_dir, f"{self.started_at.strftime('%Y%m%d_%H%M%S_%f')}.json")
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Profile report written to {path}")
+        return path
+
+
+def list_reports(job):
+    report_dir = os.path.join(PROFILES_DIR, job)
+    if not os.path.isdir(report_dir):
+        return []
+    return [os.path.join(report_dir, f) for f in sorted(os.listdir(report_dir)) if f.endswith('.json')]
+
+
+def load_report(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _stage_totals(report):
+    """Records of a report grouped by stage name (one per file or partition in most jobs), in first-seen order."""
+    totals = {}
+    for s in report["stages"]:
+        total = totals.setdefault(s["stage"], {"count": 0, "wall_seconds": 0.0, "rows": None})
+        total["count"] += 1
+        total["wall_seconds"] += s["wall_seconds"]
+        if s["rows"] is not None:
+            total["rows"] = (total["rows"] or 0) + s["rows"]
+    return totals
+
+
+def compare_reports(baseline, candidate):
+    """Per-stage wall time and row deltas between two reports (e.g. the last two runs), summed over each stage's records."""
+    base_stages = _stage_totals(baseline)
+    rows = []
+    for stage, after in _stage_totals(candidate).items():
+        before = base_stages.get(stage)
+        rows.append({
+            "stage": stage,
+            "before_count": before["count"] if before else 0,
+            "after_count": after["count"],
+            "before_seconds": before["wall_seconds"] if before else None,
+            "after_seconds": after["wall_seconds"],
+            "delta_seconds": after["wall_seconds"] - before["wall_seconds"] if before else None,
+            "before_rows": before["rows"] if before else None,
+            "after_rows": after["rows"],
+        })
+    return rows
+
+
+def top_operators(report, limit=10):
+    """Slowest physical operators across all profiled queries of a report."""
+    ops = []
+    for s in report["stages"]:
+        for q in s["queries"]:
+            for op in q["operators"]:
+                ops.append(dict(op, stage=s["stage"]))
+    return sorted(ops, key=lambda o: o["seconds"], reverse=True)[:limit]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare the last two profile reports of a job")
+    parser.add_argument("job", choices=["batch", "speed"])
+    args = parser.parse_args()
+
+    reports = list_reports(args.job)
+    if not reports:
+        print(f"No profile reports for '{args.job}'. Run the job with LAMBDA_PROFILE=1 first.")
+    else:
+        latest = load_report(reports[-1])
+        if len(reports) > 1:
+            print(f"Comparing {os.path.basename(reports[-2])} -> {os.path.basename(reports[-1])}")
+            for r in compare_reports(load_report(reports[-2]), latest):
+                before = f"{r['before_seconds']:.3f}s" if r['before_seconds'] is not None else "-"
+                print(f"  {r['stage']:<28} {before:>10} -> {r['after_seconds']:.3f}s  x{r['after_count']}  rows={r['after_rows']}")
+        print("Slowest operators in latest run:")
+        for op in top_operators(latest):
+            print(f"  {op['stage']:<28} {op['operator']:<20} {op['seconds']:.4f}s  rows={op['rows']}")
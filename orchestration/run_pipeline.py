@@ -3,21 +3,20 @@ import subprocess
 import sys
 import os
 import time
-import threading
 
 # Add parent dir
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from data_generator.generate_data import generate_batch_history, generate_users, simulate_streaming
+from data_generator.generate_data import generate_batch_history, generate_users, simulate_streaming, stream_to_server, WORKLOAD_PROFILE, WORKLOAD_PROFILES
 
-def run_setup():
+def run_setup(profile=None):
     print("[Orchestrator] Initializing Data Platform...")
     
     # 1. Generate Metadata
     generate_users()
     
     # 2. Generate Historical Data
-    generate_batch_history()
+    generate_batch_history(profile=profile)
     
     print("[Orchestrator] Raw Data Generation Complete.")
 
@@ -34,12 +33,25 @@ def run_speed_layer():
     sp = subprocess.Popen([sys.executable, speed_script])
     return sp
 
-def run_stream_simulation():
+def run_ingest_server():
+    print("[Orchestrator] Starting Speed Layer (Ingest Server)...")
+    ingest_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "speed_layer", "ingest_server.py")
+    return subprocess.Popen([sys.executable, ingest_script])
+
+def run_ingest_load(profile=None):
+    print("[Orchestrator] Starting Real-time Event Load against the Ingest Server...")
+    try:
+        while True:
+            stream_to_server(duration_sec=5, events_per_sec=200, profile=profile)
+    except KeyboardInterrupt:
+        print("Stopping simulation")
+
+def run_stream_simulation(profile=None):
     print("[Orchestrator] Starting Real-time Event Simulation...")
     # Simulate for 60 seconds loop, or forever. Let's do a loop.
     try:
         while True:
-            simulate_streaming(interval_sec=2, duration_sec=5) # burst extract
+            simulate_streaming(interval_sec=2, duration_sec=5, sink=os.environ.get("LAMBDA_STREAM_SOURCE"), profile=profile) # burst extract
             time.sleep(1)
     except KeyboardInterrupt:
         print("Stopping simulation")
@@ -47,27 +59,42 @@ def run_stream_simulation():
 def main():
     parser = argparse.ArgumentParser(description="Multi-Agent Lambda Platform Orchestrator")
     parser.add_argument("--mode", choices=['full', 'batch-only', 'stream-only'], default='full')
+    parser.add_argument("--stream-source", choices=['files', 'log', 'ingest'], default=os.getenv("LAMBDA_STREAM_SOURCE", "files"),
+                        help="Stream bus: JSON drop files, the segmented event log, or the asyncio ingest server")
+    parser.add_argument("--workload", choices=sorted(WORKLOAD_PROFILES), default=WORKLOAD_PROFILE,
+                        help="Generator workload profile (skew, bursts, duplicates, late and replayed events)")
     args = parser.parse_args()
+    # Generator (in-process) and speed layer (subprocess) both read this
+    os.environ["LAMBDA_STREAM_SOURCE"] = args.stream_source
 
     if args.mode in ['full', 'batch-only']:
-        run_setup()
+        run_setup(args.workload)
         run_batch_layer()
         
     if args.mode in ['full', 'stream-only']:
         print("[Orchestrator] Launching Speed Layer & Stream Simulation in parallel...")
         
-        # Start Spark Streaming Job
-        speed_process = run_speed_layer()
-        
-        # Give Spark a moment to initialize
-        time.sleep(10)
+        if args.stream_source == 'ingest':
+            speed_process = run_ingest_server()
+            time.sleep(2)
+        else:
+            # Start Spark Streaming Job
+            speed_process = run_speed_layer()
+            
+            # Give Spark a moment to initialize
+            time.sleep(10)
         
-        # Start Data Generator (Blocking loop)
+        # Start Data Generator (Blocking loop; returns on Ctrl+C)
         try:
-            run_stream_simulation()
-        except KeyboardInterrupt:
+            if args.stream_source == 'ingest':
+                run_ingest_load(args.workload)
+            else:
+                run_stream_simulation(args.workload)
+        finally:
             print("Stopping...")
+            # SIGTERM makes the speed layer drain its in-flight micro-batch and flush the checkpoint
             speed_process.terminate()
+            speed_process.wait(timeout=60)
 
 if __name__ == "__main__":
     main()
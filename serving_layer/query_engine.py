@@ -1,5 +1,25 @@
+import atexit
+import contextlib
 import duckdb
+import glob
+import json
+import logging
+import math
 import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from monitoring.metrics import event_lag_seconds, get_registry
+from monitoring.profiling import PROFILES_DIR, json_profiling, operator_rows
+from common.sketches import SPEED_SKETCH_DIR, hll_estimate, quantiles_from_buckets
+from common.storage import parquet_copy_options
 
 env_base = os.getenv("LAMBDA_BASE_DIR")
 if env_base:
@@ -8,25 +28,262 @@ else:
     BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 DATA_DIR = os.path.join(BASE_DIR, "data")
-BATCH_PATH = os.path.join(DATA_DIR, "processed", "batch_views", "*.parquet").replace('\\', '/')
 SPEED_PATH = os.path.join(DATA_DIR, "processed", "speed_views", "*.parquet").replace('\\', '/')
+# The batch layer publishes each run as a generation directory named in CURRENT (see
+# batch_layer/process_batch.py); views from before generations are files in BATCH_VIEW_DIR itself
+BATCH_VIEW_DIR = os.path.join(DATA_DIR, "processed", "batch_views")
+BATCH_CURRENT_FILE = os.path.join(BATCH_VIEW_DIR, "CURRENT")
+# Inside a generation: transaction_id ranges per batch file and row group, the global
+# transaction_id -> batch file map sorted on transaction_id, and the per-partition sketches
+TXID_INDEX_FILE = "_txid_index.json"
+TXID_MAP_FILE = os.path.join("_index", "txid_map.parquet")
+BATCH_SKETCH_SUBDIR = "_sketches"
+# Batch view partitions are named batch_data_<YYYY-MM-DD>.parquet (see batch_layer/process_batch.py)
+BATCH_PARTITION_PREFIX = "batch_data_"
+
+EXPORT_FORMATS = {"parquet": f"({parquet_copy_options()})", "csv": "(FORMAT CSV, HEADER)"}
+# DuckDB spills to disk beyond this, so exports of any size run in bounded memory
+EXPORT_MEMORY_LIMIT = os.getenv("LAMBDA_EXPORT_MEMORY_LIMIT", "512MB")
+SPEED_SKETCH_PATH = os.path.join(SPEED_SKETCH_DIR, "*.parquet").replace('\\', '/')
+
+# Queries at or above this many seconds are logged with the DuckDB profile of their execution;
+# every query is profiled while the threshold is set (LAMBDA_SLOW_QUERY_SEC=off, or None, turns both off)
+_slow_query_sec = os.getenv("LAMBDA_SLOW_QUERY_SEC", "1.0").strip().lower()
+SLOW_QUERY_THRESHOLD_SEC = None if _slow_query_sec in ("off", "none", "") else float(_slow_query_sec)
+QUERY_LOG_FILE = os.path.join(DATA_DIR, "logs", "serving_queries.log")
+QUERY_LOG_MAX_BYTES = 5 * 1024 * 1024
+QUERY_LOG_BACKUPS = 3
+# Results kept per ServingLayer, each valid until a file its query scanned changes
+QUERY_CACHE_ENTRIES = int(os.getenv("LAMBDA_QUERY_CACHE_ENTRIES", "16"))
+# Durations kept per query shape for the p50/p99 in get_query_stats()
+QUERY_STATS_WINDOW = 1000
+# Query metrics are written out at most this often, not per query: a flush rewrites the
+# serving snapshot and re-renders metrics.prom from every job's snapshot
+SERVING_METRICS_FLUSH_SEC = float(os.getenv("LAMBDA_SERVING_METRICS_FLUSH_SEC", "5.0"))
+
+def _sql_path_list(paths):
+    return "[" + ", ".join("'" + p.replace('\\', '/').replace("'", "''") + "'" for p in paths) + "]"
+
+def _batch_view_dir():
+    """
+    Directory of the published batch view generation. Resolve it once per query: every
+    file the query reads then comes from the same complete generation.
+    """
+    try:
+        with open(BATCH_CURRENT_FILE, 'r') as f:
+            name = f.read().strip()
+    except OSError:
+        return BATCH_VIEW_DIR
+    return os.path.join(BATCH_VIEW_DIR, name) if name else BATCH_VIEW_DIR
+
+def _batch_path(view_dir, subdir=""):
+    return os.path.join(view_dir, subdir, "*.parquet").replace('\\', '/')
+
+def _list_files(path_pattern):
+    # Normalize for glob
+    return sorted(glob.glob(path_pattern.replace('/', os.sep)))
+
+def _files_fingerprint(files):
+    state = []
+    for path in files:
+        try:
+            st = os.stat(path)
+            state.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            state.append((path, None, None))
+    return tuple(state)
+
+def _row_count(result):
+    if result is None:
+        return 0
+    if isinstance(result, tuple):
+        return 1
+    return len(result)
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+_metrics_flush_lock = threading.Lock()
+_metrics_flush_timer = None
+
+def _schedule_metrics_flush(metrics):
+    """Flushes `metrics` once SERVING_METRICS_FLUSH_SEC after the first unflushed update."""
+    global _metrics_flush_timer
+    with _metrics_flush_lock:
+        if _metrics_flush_timer is not None:
+            return
+        _metrics_flush_timer = threading.Timer(SERVING_METRICS_FLUSH_SEC, _flush_metrics, [metrics])
+        _metrics_flush_timer.daemon = True
+        _metrics_flush_timer.start()
+
+def _flush_metrics(metrics):
+    global _metrics_flush_timer
+    with _metrics_flush_lock:
+        if _metrics_flush_timer is not None:
+            _metrics_flush_timer.cancel()
+        _metrics_flush_timer = None
+    metrics.flush()
+
+@atexit.register
+def _flush_pending_metrics():
+    timer = _metrics_flush_timer
+    if timer is not None:
+        _flush_metrics(*timer.args)
+
+def _query_logger():
+    """Rotating log of slow and failed serving queries (data/logs/serving_queries.log)."""
+    logger = logging.getLogger("lambda.serving.queries")
+    log_path = os.path.abspath(QUERY_LOG_FILE)
+    if not any(getattr(h, "baseFilename", None) == log_path for h in logger.handlers):
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        handler = RotatingFileHandler(log_path, maxBytes=QUERY_LOG_MAX_BYTES, backupCount=QUERY_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
 
 class ServingLayer:
-    def __init__(self):
+    def __init__(self, slow_query_threshold=SLOW_QUERY_THRESHOLD_SEC, cache_entries=QUERY_CACHE_ENTRIES):
         self.con = duckdb.connect(database=':memory:')
-        
-    def _check_files_exist(self, path_pattern):
-        import glob
-        # Normalize for glob
-        return len(glob.glob(path_pattern.replace('/', os.sep))) > 0
+        self.metrics = get_registry("serving")
+        self.slow_query_threshold = slow_query_threshold
+        self.cache_entries = cache_entries
+        self._txid_index = None
+        self._txid_index_version = None
+        self._cache = OrderedDict()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _cursor(self):
+        # DuckDB connections are not safe to share across threads; each call gets its own cursor
+        return self.con.cursor()
+
+    def flush_metrics(self):
+        """Writes the serving metrics out now instead of waiting for the flush timer."""
+        _flush_metrics(self.metrics)
+
+    def _record_query(self, shape, seconds, rows, files_scanned, cache):
+        self.metrics.observe("lambda_serving_query_duration_seconds", seconds, query=shape)
+        _schedule_metrics_flush(self.metrics)
+        with self._lock:
+            stats = self._stats.setdefault(shape, {
+                "count": 0, "errors": 0, "cache_hits": 0, "rows": 0, "files_scanned": 0,
+                "durations": deque(maxlen=QUERY_STATS_WINDOW),
+            })
+            stats["count"] += 1
+            stats["errors"] += cache == "error"
+            stats["cache_hits"] += cache == "hit"
+            stats["rows"] += rows
+            stats["files_scanned"] += files_scanned
+            stats["durations"].append(seconds)
+
+    def _run(self, shape, sql, params=None, files=(), fetch="df", cursor=None, cache=True, on_result=None):
+        """
+        Executes one serving query and records its duration, rows, files scanned and cache status.
+        Results of queries over `files` are cached, one entry per (shape, sql, params), and are
+        valid until one of those files changes. Queries with `cache=False` or on a `cursor` with
+        registered DataFrames bypass the cache. Queries slower than the threshold are written to
+        the query log with the JSON profile DuckDB recorded while running them. `on_result` is
+        called with a fresh result before the query is recorded, so metrics it sets go out with it.
+        """
+        start = time.perf_counter()
+        key = None
+        if cache and cursor is None and self.cache_entries > 0:
+            key = (shape, sql, repr(params), fetch)
+            fingerprint = _files_fingerprint(files)
+            with self._lock:
+                entry = self._cache.get(key)
+                if entry is not None and entry[0] == fingerprint:
+                    self._cache.move_to_end(key)
+                    cached = entry[1]
+                else:
+                    cached = None
+            if cached is not None:
+                self._record_query(shape, time.perf_counter() - start, _row_count(cached), 0, "hit")
+                return cached.copy() if fetch == "df" else cached
+
+        cur = cursor or self._cursor()
+        profiling = self.slow_query_threshold is not None
+        # Per thread: concurrent queries each get their own profile file
+        profile_path = os.path.join(PROFILES_DIR, f".serving_{os.getpid()}_{threading.get_ident()}_query.json")
+        profiler = json_profiling(cur, profile_path) if profiling else contextlib.nullcontext({"profile": None})
+        try:
+            with profiler as captured:
+                relation = cur.execute(sql, params)
+                if fetch == "df":
+                    result = relation.df()
+                elif fetch == "one":
+                    result = relation.fetchone()
+                else:
+                    result = relation.fetchall()
+        except Exception as e:
+            self._record_query(shape, time.perf_counter() - start, 0, len(files), "error")
+            _query_logger().error("query failed shape=%s error=%s\nSQL: %s\nparams: %r", shape, e, " ".join(sql.split()), params)
+            raise
+        seconds = time.perf_counter() - start
+        if on_result is not None:
+            on_result(result)
+        self._record_query(shape, seconds, _row_count(result), len(files), "miss" if key is not None else "bypass")
+
+        if key is not None:
+            with self._lock:
+                # Replaces the entry of files that changed since; the caller gets its own DataFrame,
+                # the cached one is never handed out directly
+                self._cache[key] = (fingerprint, result.copy() if fetch == "df" else result)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_entries:
+                    self._cache.popitem(last=False)
+        if profiling and seconds >= self.slow_query_threshold:
+            self._log_slow_query(shape, sql, params, seconds, _row_count(result), len(files), captured["profile"])
+        return result
+
+    def _log_slow_query(self, shape, sql, params, seconds, rows, files_scanned, profile):
+        if profile is None:
+            plan = "no profile recorded"
+        else:
+            plan = f"profile latency={profile.get('latency', 0.0):.4f}s\n" + "\n".join(
+                f"{'  ' * op['depth']}{op['operator']} {op['seconds']:.4f}s rows={op['rows']}" for op in operator_rows(profile)
+            )
+        _query_logger().warning(
+            "slow query shape=%s seconds=%.3f rows=%d files_scanned=%d\nSQL: %s\nparams: %r\n%s",
+            shape, seconds, rows, files_scanned, " ".join(sql.split()), params, plan,
+        )
+
+    def get_query_stats(self):
+        """
+        Per query shape since this ServingLayer was created: executions, errors, cache hits,
+        p50/p99 duration (over the last QUERY_STATS_WINDOW runs), average rows and files scanned.
+        """
+        columns = ["query", "count", "errors", "cache_hits", "p50_seconds", "p99_seconds", "avg_rows", "avg_files_scanned"]
+        rows = []
+        with self._lock:
+            for shape, stats in sorted(self._stats.items()):
+                durations = sorted(stats["durations"])
+                rows.append({
+                    "query": shape,
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "cache_hits": stats["cache_hits"],
+                    "p50_seconds": _percentile(durations, 0.5),
+                    "p99_seconds": _percentile(durations, 0.99),
+                    "avg_rows": stats["rows"] / stats["count"],
+                    "avg_files_scanned": stats["files_scanned"] / stats["count"],
+                })
+        return pd.DataFrame(rows, columns=columns)
 
     def get_unified_view(self):
         """
         Constructs the Lambda Architecture View.
         Uses DuckDB to perform a robust UNION across potentially different schemas.
         """
-        has_batch = self._check_files_exist(BATCH_PATH)
-        has_speed = self._check_files_exist(SPEED_PATH)
+        batch_path = _batch_path(_batch_view_dir())
+        batch_files = _list_files(batch_path)
+        speed_files = _list_files(SPEED_PATH)
+        has_batch = bool(batch_files)
+        has_speed = bool(speed_files)
         
         if not has_batch and not has_speed:
             return None
@@ -34,7 +291,7 @@ class ServingLayer:
         # Use DuckDB to handle the union. We'll explicitly select columns to ensure alignment.
         # Speed layer might miss joined columns (name, region), we fill with NULL.
         
-        batch_part = f"SELECT transaction_id, user_id, product, amount, timestamp, status, user_name, region, processed_at FROM read_parquet('{BATCH_PATH}')"
+        batch_part = f"SELECT transaction_id, user_id, product, amount, timestamp, status, user_name, region, processed_at FROM read_parquet('{batch_path}')"
         speed_part = f"SELECT transaction_id, user_id, product, amount, event_time as timestamp, status, NULL as user_name, NULL as region, processed_at FROM read_parquet('{SPEED_PATH}')"
         
         query = ""
@@ -47,24 +304,34 @@ class ServingLayer:
             query = speed_part_only
             
         try:
-            return self.con.query(query).to_df()
+            # The whole view is never cached: one full copy per entry would hold every row in memory
+            df = self._run("unified_view", query, files=batch_files + speed_files, cache=False, on_result=self._set_freshness)
         except Exception as e:
             print(f"Serving Layer Query Error: {e}")
             return None
+        return df
+
+    def _set_freshness(self, df):
+        if df.empty:
+            return
+        newest = pd.to_datetime(df['timestamp']).max()
+        if not pd.isna(newest):
+            self.metrics.set("lambda_data_freshness_seconds", event_lag_seconds(newest.to_pydatetime()))
 
     def get_kpis(self):
         df = self.get_unified_view()
         if df is None or df.empty:
             return {"total_sales": 0, "transaction_count": 0, "avg_order_value": 0}
             
-        self.con.register('unified_view', df)
-        kpis = self.con.query("""
+        cur = self._cursor()
+        cur.register('unified_view', df)
+        kpis = self._run("kpis", """
             SELECT 
                 CAST(SUM(amount) AS DOUBLE) as total_sales,
                 COUNT(*) as transaction_count,
                 CAST(AVG(amount) AS DOUBLE) as avg_order_value
             FROM unified_view
-        """).fetchone()
+        """, fetch="one", cursor=cur)
         
         return {
             "total_sales": kpis[0] if kpis[0] is not None else 0,
@@ -75,7 +342,246 @@ class ServingLayer:
     def get_recent_transactions(self, limit=10):
         df = self.get_unified_view()
         if df is None or df.empty:
-            import pandas as pd
             return pd.DataFrame()
-        self.con.register('unified_view', df)
-        return self.con.query(f"SELECT * FROM unified_view ORDER BY timestamp DESC LIMIT {limit}").to_df()
+        cur = self._cursor()
+        cur.register('unified_view', df)
+        return self._run("recent_transactions", f"SELECT * FROM unified_view ORDER BY timestamp DESC LIMIT {int(limit)}", cursor=cur)
+
+    def _load_txid_index(self, view_dir):
+        """A generation's transaction_id side index, cached until another index file is read."""
+        index_path = os.path.join(view_dir, TXID_INDEX_FILE)
+        try:
+            version = (index_path, os.path.getmtime(index_path))
+        except OSError:
+            return None
+        if self._txid_index_version != version:
+            try:
+                with open(index_path, 'r') as f:
+                    self._txid_index = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._txid_index_version = version
+        return self._txid_index
+
+    def _mapped_files(self, view_dir, transaction_id):
+        """Batch files the transaction_id map assigns the id to, or None without a readable map."""
+        map_path = os.path.join(view_dir, TXID_MAP_FILE).replace('\\', '/')
+        if not os.path.exists(map_path):
+            return None
+        try:
+            rows = self._run(
+                "txid_map_lookup", f"SELECT DISTINCT file FROM read_parquet('{map_path}') WHERE transaction_id = ?",
+                [transaction_id], files=[map_path], fetch="all",
+            )
+        except Exception as e:
+            print(f"Serving Layer transaction_id map unreadable: {e}")
+            return None
+        return {file for (file,) in rows}
+
+    def _batch_files_for(self, transaction_id):
+        """
+        Batch files that can hold `transaction_id`: the one the id map points at (at most one,
+        as the batch view is deduplicated), or without a map those whose indexed id ranges
+        cover it. Files missing from the index, or rewritten since it was built, are always included.
+        """
+        view_dir = _batch_view_dir()
+        index = self._load_txid_index(view_dir)
+        mapped = self._mapped_files(view_dir, transaction_id) if index else None
+        candidates = []
+        for path in sorted(glob.glob(os.path.join(view_dir, "*.parquet"))):
+            name = os.path.basename(path)
+            entry = index["files"].get(name) if index else None
+            if entry is None or entry["mtime"] != os.path.getmtime(path):
+                candidates.append(path)
+            elif mapped is not None:
+                if name in mapped:
+                    candidates.append(path)
+            elif any(lo is not None and lo <= transaction_id <= hi for _, _, lo, hi in entry["row_groups"]):
+                candidates.append(path)
+        return candidates
+
+    def get_transaction(self, transaction_id):
+        """
+        Every batch and speed record of one transaction, oldest first, tagged with its `layer`.
+        The batch file is found with the transaction_id map, and because batch views are sorted
+        on transaction_id DuckDB's min/max pruning then reads a single row group of it.
+        """
+        parts = []
+        params = []
+        batch_files = self._batch_files_for(transaction_id)
+        speed_files = _list_files(SPEED_PATH)
+        if batch_files:
+            parts.append(f"""
+                SELECT 'batch' AS layer, transaction_id, user_id, product, amount, timestamp, status, user_name, region, processed_at
+                FROM read_parquet({_sql_path_list(batch_files)})
+                WHERE transaction_id = ?
+            """)
+            params.append(transaction_id)
+        if speed_files:
+            parts.append(f"""
+                SELECT 'speed' AS layer, transaction_id, user_id, product, amount, event_time AS timestamp, status, NULL AS user_name, NULL AS region, processed_at
+                FROM read_parquet('{SPEED_PATH}')
+                WHERE transaction_id = ?
+            """)
+            params.append(transaction_id)
+        if not parts:
+            return pd.DataFrame()
+
+        try:
+            return self._run("get_transaction", " UNION ALL ".join(parts) + " ORDER BY processed_at", params, files=batch_files + speed_files)
+        except Exception as e:
+            print(f"Serving Layer Query Error: {e}")
+            return pd.DataFrame()
+
+    def _merge_sketches(self, shape, kind, merge_agg, start=None, end=None):
+        """
+        Per-key merge of the hourly batch and speed sketches of one `kind` in [start, end).
+        Layers are combined like the unified view (batch UNION ALL speed); the range is
+        applied on whole hours, so `start` is rounded down to its hour.
+        """
+        batch_sketch_path = _batch_path(_batch_view_dir(), BATCH_SKETCH_SUBDIR)
+        files = {path: _list_files(path) for path in (batch_sketch_path, SPEED_SKETCH_PATH)}
+        sources = [path for path, matched in files.items() if matched]
+        if not sources:
+            return []
+        union = " UNION ALL ".join(
+            f"SELECT hour, key, value FROM read_parquet('{path}') WHERE kind = '{kind}'" for path in sources
+        )
+        return self._run(shape, f"""
+            SELECT key, {merge_agg}(value)
+            FROM ({union})
+            WHERE ($start IS NULL OR hour >= date_trunc('hour', CAST($start AS TIMESTAMP)))
+              AND ($end IS NULL OR hour < CAST($end AS TIMESTAMP))
+            GROUP BY key
+        """, {"start": start, "end": end}, files=files[batch_sketch_path] + files[SPEED_SKETCH_PATH], fetch="all")
+
+    def get_distinct_users(self, start=None, end=None):
+        """Approximate distinct user_ids with events in [start, end), from merged HyperLogLog registers."""
+        registers = self._merge_sketches("distinct_users", "hll", "MAX", start, end)
+        return round(hll_estimate(dict(registers))) if registers else 0
+
+    def get_amount_percentiles(self, start=None, end=None, quantiles=(0.5, 0.95)):
+        """Approximate order value quantiles in [start, end), e.g. {"p50": ..., "p95": ...} (None when empty)."""
+        buckets = self._merge_sketches("amount_percentiles", "amount", "SUM", start, end)
+        return {f"p{q * 100:g}": value for q, value in quantiles_from_buckets(buckets, quantiles).items()}
+
+    def _batch_files_between(self, start=None, end=None):
+        """Batch view files that can hold events in [start, end], skipping date partitions outside it."""
+        files = sorted(glob.glob(os.path.join(_batch_view_dir(), "*.parquet")))
+        if start is None and end is None:
+            return files
+        lo = pd.Timestamp(start).date() if start is not None else None
+        hi = pd.Timestamp(end).date() if end is not None else None
+        selected = []
+        for path in files:
+            name = os.path.basename(path)[:-len(".parquet")]
+            try:
+                day = datetime.strptime(name[len(BATCH_PARTITION_PREFIX):], "%Y-%m-%d").date()
+            except ValueError:
+                # Not a dated partition: undated rows never match a time filter, anything else is scanned
+                if name != f"{BATCH_PARTITION_PREFIX}undated":
+                    selected.append(path)
+                continue
+            if (lo is None or day >= lo) and (hi is None or day <= hi):
+                selected.append(path)
+        return selected
+
+    def export(self, path, fmt=None, start=None, end=None, products=None, regions=None, statuses=None,
+               progress=None, poll_interval=0.5, memory_limit=EXPORT_MEMORY_LIMIT):
+        """
+        Streams a filtered slice of the unified view (batch UNION ALL speed) to `path` with a
+        DuckDB COPY, as Parquet or CSV (`fmt`, default from the file extension). Rows never pass
+        through Python: the copy runs on its own connection capped at `memory_limit` and spills
+        beyond it. Filters: [start, end) on timestamp, and product / region / status membership;
+        only batch date partitions inside the time range are read. `progress(percent)` is called
+        every `poll_interval` seconds while the copy runs, and with 100.0 when it is done.
+        Returns the number of rows written.
+        """
+        fmt = (fmt or os.path.splitext(path)[1].lstrip('.') or "parquet").lower()
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format '{fmt}', expected one of {sorted(EXPORT_FORMATS)}")
+        begin = time.perf_counter()
+
+        parts = []
+        batch_files = self._batch_files_between(start, end)
+        if batch_files:
+            parts.append(f"SELECT transaction_id, user_id, product, amount, timestamp, status, user_name, region, processed_at FROM read_parquet({_sql_path_list(batch_files)})")
+        speed_files = _list_files(SPEED_PATH)
+        if speed_files:
+            parts.append(f"SELECT transaction_id, user_id, product, amount, event_time as timestamp, status, NULL as user_name, NULL as region, processed_at FROM read_parquet('{SPEED_PATH}')")
+        if not parts:
+            return 0
+
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("timestamp >= CAST(? AS TIMESTAMP)")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp < CAST(? AS TIMESTAMP)")
+            params.append(end)
+        for column, values in (("product", products), ("region", regions), ("status", statuses)):
+            if values:
+                conditions.append(f"list_contains(?, {column})")
+                params.append(list(values))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        out_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(out_dir, exist_ok=True)
+        tmp_path = os.path.join(out_dir, f".{os.path.basename(path)}.tmp").replace('\\', '/')
+        con = duckdb.connect()
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+        # Without an ORDER BY, dropping insertion order lets COPY stream instead of buffering
+        con.execute("SET preserve_insertion_order = false")
+        con.execute("SET enable_progress_bar = true")
+        con.execute("SET enable_progress_bar_print = false")
+
+        outcome = {}
+        def run_copy():
+            try:
+                outcome["rows"] = con.execute(
+                    f"COPY (SELECT * FROM ({' UNION ALL '.join(parts)}) {where}) TO '{tmp_path}' {EXPORT_FORMATS[fmt]}",
+                    params,
+                ).fetchone()[0]
+            except Exception as e:
+                outcome["error"] = e
+
+        worker = threading.Thread(target=run_copy, daemon=True)
+        worker.start()
+        while worker.is_alive():
+            worker.join(poll_interval)
+            if progress is not None and worker.is_alive():
+                percent = con.query_progress()
+                if percent >= 0:
+                    progress(percent)
+        con.close()
+        files_scanned = len(batch_files) + len(speed_files)
+        if "error" in outcome:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._record_query("export", time.perf_counter() - begin, 0, files_scanned, "error")
+            raise outcome["error"]
+
+        os.replace(tmp_path, path)
+        if progress is not None:
+            progress(100.0)
+        self._record_query("export", time.perf_counter() - begin, outcome["rows"], files_scanned, "bypass")
+        return outcome["rows"]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export a filtered slice of the unified view")
+    parser.add_argument("path", help="Output file (.parquet or .csv)")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default=None)
+    parser.add_argument("--start", help="Inclusive start timestamp, e.g. 2024-05-01")
+    parser.add_argument("--end", help="Exclusive end timestamp")
+    parser.add_argument("--product", action="append", help="Repeat to include several")
+    parser.add_argument("--region", action="append", help="Repeat to include several")
+    parser.add_argument("--status", action="append", help="Repeat to include several")
+    parser.add_argument("--memory-limit", default=EXPORT_MEMORY_LIMIT)
+    args = parser.parse_args()
+    rows = ServingLayer().export(
+        args.path, args.format, args.start, args.end, args.product, args.region, args.status,
+        progress=lambda pct: print(f"Exporting... {pct:5.1f}%"), memory_limit=args.memory_limit,
+    )
+    print(f"Exported {rows} rows to {args.path}")
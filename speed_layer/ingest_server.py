@@ -0,0 +1,294 @@
+import asyncio
+import io
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pa_json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from monitoring.metrics import event_lag_seconds, get_registry
+from event_bus.schema import STREAM_EVENT_SCHEMA
+from common.sketches import SPEED_SKETCH_DIR, write_sketches
+from common.storage import write_parquet
+from speed_layer.process_stream import SPEED_OUTPUT
+
+INGEST_HOST = os.getenv("LAMBDA_INGEST_HOST", "127.0.0.1")
+INGEST_PORT = int(os.getenv("LAMBDA_INGEST_PORT", "9009"))
+
+# A buffer is flushed to a speed view file when either threshold is hit
+FLUSH_MAX_ROWS = int(os.getenv("LAMBDA_INGEST_FLUSH_ROWS", "5000"))
+FLUSH_MAX_LATENCY_SEC = float(os.getenv("LAMBDA_INGEST_FLUSH_SEC", "0.5"))
+
+READ_CHUNK_BYTES = 256 * 1024
+# A client sending more than this without a newline is disconnected instead of being buffered
+MAX_LINE_BYTES = int(os.getenv("LAMBDA_INGEST_MAX_LINE_BYTES", str(1024 * 1024)))
+# On shutdown, connected clients get this long to finish sending before they are cut off
+SHUTDOWN_DRAIN_SEC = 5.0
+# The shutdown flush is retried this often, this far apart, before its rows are dropped
+FINAL_FLUSH_ATTEMPTS = 3
+FINAL_FLUSH_RETRY_SEC = 1.0
+
+# Same layout the DuckDB micro-batch writes, so the serving layer unions it unchanged:
+# the event timestamp is stored once, as event_time
+SPEED_VIEW_SCHEMA = pa.schema([f for f in STREAM_EVENT_SCHEMA if f.name != "timestamp"] + [
+    ("event_time", pa.timestamp("us")),
+    ("processed_at", pa.timestamp("us", tz="UTC")),
+])
+
+
+def _parse_lines(payload):
+    """Parses a block of complete NDJSON lines into one Arrow table, dropping invalid lines."""
+    parse_options = pa_json.ParseOptions(explicit_schema=STREAM_EVENT_SCHEMA, unexpected_field_behavior="ignore")
+    try:
+        return pa_json.read_json(io.BytesIO(payload), parse_options=parse_options), 0
+    except (pa.ArrowInvalid, ValueError):
+        # Slow path only when the block contains a bad record: each line goes through the same
+        # reader, so non-objects, mistyped fields and timestamps are judged exactly as above
+        tables, rejected = [], 0
+        for line in payload.splitlines():
+            if not line.strip():
+                continue
+            try:
+                tables.append(pa_json.read_json(io.BytesIO(line + b"\n"), parse_options=parse_options))
+            except (pa.ArrowInvalid, ValueError):
+                rejected += 1
+        if not tables:
+            return STREAM_EVENT_SCHEMA.empty_table(), rejected
+        return pa.concat_tables(tables), rejected
+
+
+class IngestServer:
+    """
+    Asyncio ingestion endpoint for newline-delimited JSON events over TCP or a Unix socket.
+    Incoming bytes are parsed per read chunk straight into Arrow record batches and buffered
+    in memory; the buffer is written as a speed view Parquet file as soon as it holds
+    `max_rows` events or its oldest event has waited `max_latency` seconds. This skips the
+    file drop and the speed layer's poll, giving sub-second freshness.
+    """
+
+    def __init__(self, host=INGEST_HOST, port=INGEST_PORT, unix_path=None,
+                 max_rows=FLUSH_MAX_ROWS, max_latency=FLUSH_MAX_LATENCY_SEC, output_dir=SPEED_OUTPUT,
+                 max_line_bytes=MAX_LINE_BYTES):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.output_dir = output_dir
+        self.max_line_bytes = max_line_bytes
+        self.metrics = get_registry("ingest")
+        self.events_received = 0
+        self.events_rejected = 0
+        self.files_written = 0
+        self.events_dropped = 0
+        self._buffer = []
+        self._buffered_rows = 0
+        self._buffer_started = None
+        self._flush_seq = 0
+        self._server = None
+        self._clients = set()
+        self._loop = None
+        self._stopped = None
+        self._ready = threading.Event()
+
+    @property
+    def address(self):
+        if self.unix_path:
+            return self.unix_path
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def _handle_client(self, reader, writer):
+        pending = b""
+        self._clients.add(asyncio.current_task())
+        try:
+            while True:
+                chunk = await reader.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                pending += chunk
+                cut = pending.rfind(b"\n")
+                if cut >= 0:
+                    complete, pending = pending[:cut + 1], pending[cut + 1:]
+                    self._buffer_batch(complete)
+                    if self._buffered_rows >= self.max_rows:
+                        await self._try_flush()
+                if len(pending) > self.max_line_bytes:
+                    # No record is that long; the client is not sending NDJSON
+                    print(f"Ingest client sent over {self.max_line_bytes} bytes without a newline, disconnecting")
+                    self.events_rejected += 1
+                    pending = b""
+                    break
+            if pending.strip():
+                self._buffer_batch(pending + b"\n")
+        finally:
+            self._clients.discard(asyncio.current_task())
+            writer.close()
+
+    def _buffer_batch(self, payload):
+        table, rejected = _parse_lines(payload)
+        self.events_rejected += rejected
+        if table.num_rows == 0:
+            return
+        if self._buffer_started is None:
+            self._buffer_started = time.monotonic()
+        self._buffer.append(table)
+        self._buffered_rows += table.num_rows
+        self.events_received += table.num_rows
+
+    async def _flush_timer(self):
+        tick = max(self.max_latency / 4, 0.01)
+        while True:
+            await asyncio.sleep(tick)
+            if self._buffer_started is not None and time.monotonic() - self._buffer_started >= self.max_latency:
+                await self._try_flush()
+
+    async def _try_flush(self):
+        # A failed write keeps its rows buffered for the next attempt; the timer and clients carry on
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Ingest flush failed, {self._buffered_rows} events kept buffered: {e}")
+
+    async def flush(self):
+        """Swaps out the current buffer and writes it as one speed view Parquet file."""
+        if not self._buffer:
+            return None
+        tables, rows, started = self._buffer, self._buffered_rows, self._buffer_started
+        self._buffer, self._buffered_rows, self._buffer_started = [], 0, None
+        self._flush_seq += 1
+        file_name = f"speed_ingest_{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{self._flush_seq:06d}.parquet"
+
+        flush_start = time.perf_counter()
+        # Parquet encoding happens off the event loop so clients keep streaming meanwhile
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_file, tables, file_name)
+        except Exception:
+            # Nothing became visible: put the rows back ahead of anything buffered since
+            self._buffer = tables + self._buffer
+            self._buffered_rows += rows
+            self._buffer_started = started if self._buffer_started is None else min(started, self._buffer_started)
+            raise
+        self.files_written += 1
+
+        self.metrics.inc("lambda_rows_written_total", rows, layer="speed_ingest")
+        self.metrics.observe("lambda_micro_batch_duration_seconds", time.perf_counter() - flush_start, layer="speed_ingest")
+        self.metrics.observe("lambda_ingest_buffer_wait_seconds", time.monotonic() - started)
+        oldest = pc.min(pa.concat_tables(tables)["timestamp"]).as_py()
+        if oldest is not None:
+            self.metrics.observe("lambda_event_processing_lag_seconds", event_lag_seconds(oldest))
+        self.metrics.flush()
+        return file_name
+
+    def _write_file(self, tables, file_name):
+        events = pa.concat_tables(tables)
+        processed_at = pa.array([datetime.now(timezone.utc)] * events.num_rows, type=pa.timestamp("us", tz="UTC"))
+        view = (
+            events.select([name for name in events.column_names if name != "timestamp"])
+            .append_column("event_time", events["timestamp"])
+            .append_column("processed_at", processed_at)
+        )
+        os.makedirs(self.output_dir, exist_ok=True)
+        tmp_path = os.path.join(self.output_dir, f".{file_name}.tmp")
+        try:
+            write_parquet(view.cast(SPEED_VIEW_SCHEMA), tmp_path)
+            # Rename last so the serving layer's glob only ever sees complete files
+            os.replace(tmp_path, os.path.join(self.output_dir, file_name))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # The rows are published now; a sketch failure must not make flush() buffer them again
+        try:
+            con = duckdb.connect()
+            con.register("ingested", view)
+            write_sketches(con, "ingested", os.path.join(SPEED_SKETCH_DIR, file_name), time_col="event_time")
+            con.close()
+        except Exception as e:
+            print(f"Sketch write failed for {file_name}: {e}")
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self.unix_path:
+            self._server = await asyncio.start_unix_server(self._handle_client, path=self.unix_path)
+        else:
+            self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        timer = asyncio.create_task(self._flush_timer())
+        print(f"Ingest server listening on {self.address} (flush at {self.max_rows} rows or {self.max_latency}s)")
+        self._ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            timer.cancel()
+            self._server.close()
+            if self._clients:
+                # Closing the server does not wait for open connections; let them drain first
+                await asyncio.wait(set(self._clients), timeout=SHUTDOWN_DRAIN_SEC)
+            await self._server.wait_closed()
+            await self._final_flush()
+            print(f"Ingest server stopped. {self.events_received} events in {self.files_written} files.")
+
+    async def _final_flush(self):
+        for attempt in range(1, FINAL_FLUSH_ATTEMPTS + 1):
+            try:
+                await self.flush()
+                return
+            except Exception as e:
+                if attempt < FINAL_FLUSH_ATTEMPTS:
+                    print(f"Final ingest flush failed (attempt {attempt}/{FINAL_FLUSH_ATTEMPTS}), retrying: {e}")
+                    await asyncio.sleep(FINAL_FLUSH_RETRY_SEC)
+                    continue
+                self.events_dropped += self._buffered_rows
+                print(f"Final ingest flush failed, dropping {self._buffered_rows} buffered events: {e}")
+                self._buffer, self._buffered_rows, self._buffer_started = [], 0, None
+
+    def stop(self):
+        """Thread-safe: stops accepting events, flushes the buffer and returns from `serve()`."""
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def start_in_thread(self):
+        """Runs the server on its own event loop in a background thread (tests, embedding)."""
+        thread = threading.Thread(target=lambda: asyncio.run(self.serve()), daemon=True)
+        thread.start()
+        self._ready.wait(timeout=10)
+        return thread
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="NDJSON ingestion server feeding the speed views")
+    parser.add_argument("--host", default=INGEST_HOST)
+    parser.add_argument("--port", type=int, default=INGEST_PORT)
+    parser.add_argument("--unix", dest="unix_path", default=None, help="Listen on a Unix socket instead of TCP")
+    parser.add_argument("--max-rows", type=int, default=FLUSH_MAX_ROWS)
+    parser.add_argument("--max-latency", type=float, default=FLUSH_MAX_LATENCY_SEC)
+    args = parser.parse_args()
+
+    server = IngestServer(args.host, args.port, args.unix_path, args.max_rows, args.max_latency)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, server.stop)
+            except NotImplementedError:
+                pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+        await server.serve()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("Stopping Ingest Server.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,23 @@
 import duckdb
+import io
 import os
+import signal
+import sys
+import threading
 import time
-import json
-from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.ipc as pa_ipc
+import pyarrow.json as pa_json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from monitoring.metrics import event_lag_seconds, get_registry
+from monitoring.profiling import Profiler
+from event_bus.event_log import EventLog
+from event_bus.schema import STREAM_EVENT_SCHEMA
+from common.sketches import SPEED_SKETCH_DIR, write_sketches
+from common.storage import parquet_copy_options
 
 # Path Setup
 env_base = os.getenv("LAMBDA_BASE_DIR")
@@ -14,66 +29,322 @@ else:
 DATA_DIR = os.path.join(BASE_DIR, "data")
 STREAM_INPUT = os.path.join(DATA_DIR, "raw", "stream")
 SPEED_OUTPUT = os.path.join(DATA_DIR, "processed", "speed_views")
+CHECKPOINT_FILE = os.path.join(DATA_DIR, "speed_checkpoint.txt")
+# Event log records that do not parse against the stream schema, kept for inspection
+DEAD_LETTER_DIR = os.path.join(DATA_DIR, "dead_letter")
+
+# Drop-file formats the micro-batch understands: JSON lines or Arrow IPC (columnar, no text decoding)
+STREAM_FILE_EXTENSIONS = ('.json', '.arrow')
+
+# Trigger cadence of the streaming loop; new files wake it up earlier
+TRIGGER_INTERVAL_SEC = float(os.getenv("LAMBDA_SPEED_TRIGGER_SEC", "5"))
+WATCH_INTERVAL_SEC = 0.25
 
-def process_stream_micro_batch():
+# Stream source: "files" (one JSON drop file per micro-batch) or "log" (segmented event log)
+STREAM_SOURCE = os.getenv("LAMBDA_STREAM_SOURCE", "files")
+LOG_CONSUMER_GROUP = "speed_layer"
+LOG_MAX_RECORDS = int(os.getenv("LAMBDA_LOG_MAX_RECORDS", "5000"))
+LOG_RETENTION_SEGMENTS = int(os.getenv("LAMBDA_LOG_RETENTION_SEGMENTS", "8"))
+
+
+def write_checkpoint(processed_files, checkpoint_file=CHECKPOINT_FILE):
+    """Atomically replaces the checkpoint so a crash never leaves it half-written."""
+    tmp_path = f"{checkpoint_file}.tmp"
+    with open(tmp_path, 'w') as f:
+        for f_name in sorted(processed_files):
+            f.write(f_name + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_file)
+
+def process_stream_micro_batch(profile=None):
     """Simulates a single micro-batch of structured streaming using DuckDB."""
     os.makedirs(SPEED_OUTPUT, exist_ok=True)
     
     # Simple file-based "checkpointer": track processed files
-    checkpoint_file = os.path.join(DATA_DIR, "speed_checkpoint.txt")
+    checkpoint_file = CHECKPOINT_FILE
     processed_files = set()
     if os.path.exists(checkpoint_file):
         with open(checkpoint_file, 'r') as f:
             processed_files = set(line.strip() for line in f)
 
     # List new files
-    all_files = [f for f in os.listdir(STREAM_INPUT) if f.endswith('.json')]
+    if not os.path.isdir(STREAM_INPUT):
+        return 0
+    all_files = [f for f in os.listdir(STREAM_INPUT) if f.endswith(STREAM_FILE_EXTENSIONS)]
     new_files = [f for f in all_files if f not in processed_files]
 
     if not new_files:
         return 0
 
+    metrics = get_registry("speed")
+    profiler = Profiler("speed", enabled=profile)
+    batch_start = time.perf_counter()
     con = duckdb.connect()
     
     batch_count = 0
     for file_name in new_files:
         file_path = os.path.join(STREAM_INPUT, file_name)
-        output_file = f"speed_{file_name.replace('.json', '')}.parquet"
+        output_file = f"speed_{os.path.splitext(file_name)[0]}.parquet"
         output_path = os.path.join(SPEED_OUTPUT, output_file)
+        src = file_path.replace('\\', '/')
+        dst = output_path.replace('\\', '/')
         
         try:
+            if file_name.endswith('.arrow'):
+                # Memory-mapped IPC file: DuckDB scans the Arrow buffers in place (zero-copy)
+                con.register("stream_events", pa_ipc.open_file(pa.memory_map(file_path, 'r')).read_all())
+                source = "stream_events"
+            else:
+                source = f"read_json_auto('{src}')"
+            # The event timestamp is stored once, typed, as event_time
             query = f"""
                 COPY (
                     SELECT 
-                        *,
+                        * EXCLUDE (timestamp),
                         CAST(timestamp AS TIMESTAMP) as event_time,
                         now() as processed_at
-                    FROM read_json_auto('{file_path.replace('\\', '/')}')
-                ) TO '{output_path.replace('\\', '/')}' (FORMAT PARQUET);
+                    FROM {source}
+                ) TO '{dst}' ({parquet_copy_options()});
             """
-            con.execute(query)
+            with profiler.stage("ingest_file") as stage:
+                stage["file"] = file_name
+                rows = profiler.execute(con, query)[0][0]
+                stage["rows"] = rows
+            if source == "stream_events":
+                con.unregister("stream_events")
+            with profiler.stage("sketches"):
+                write_sketches(con, f"read_parquet('{dst}')", os.path.join(SPEED_SKETCH_DIR, output_file),
+                               time_col="event_time", execute=profiler.execute)
             processed_files.add(file_name)
             batch_count += 1
+
+            with profiler.stage("event_lag"):
+                oldest_event = profiler.execute(con, f"SELECT MIN(event_time) FROM read_parquet('{dst}')")[0][0]
+            metrics.inc("lambda_files_ingested_total", layer="speed")
+            metrics.inc("lambda_rows_written_total", rows, layer="speed")
+            if oldest_event is not None:
+                metrics.observe("lambda_event_processing_lag_seconds", event_lag_seconds(oldest_event))
         except Exception as e:
             print(f"Error processing {file_name}: {e}")
 
     # Update checkpoint
-    with open(checkpoint_file, 'w') as f:
-        for f_name in processed_files:
-            f.write(f_name + "\n")
-            
+    with profiler.stage("checkpoint") as stage:
+        write_checkpoint(processed_files, checkpoint_file)
+        stage["rows"] = len(processed_files)
+
+    metrics.observe("lambda_micro_batch_duration_seconds", time.perf_counter() - batch_start)
+    metrics.set("lambda_last_run_timestamp_seconds", time.time(), layer="speed")
+    metrics.flush()
+    profiler.write_report()
     return batch_count
 
-def process_stream():
-    print("Starting Speed Layer (Micro-batch simulation via DuckDB)...")
+def parse_log_records(payload, dead_letter_path):
+    """
+    Parses a partition's batch of NDJSON records against the stream schema. Records that do
+    not parse (corrupted or of another schema) are written to `dead_letter_path` instead of
+    failing the whole batch. Returns the parsed events and the number of records rejected.
+    """
+    options = pa_json.ParseOptions(explicit_schema=STREAM_EVENT_SCHEMA)
     try:
-        while True:
-            count = process_stream_micro_batch()
-            if count > 0:
-                print(f"Processed {count} new stream files.")
-            time.sleep(5) # Trigger every 5 seconds
-    except KeyboardInterrupt:
-        print("Stopping Speed Layer.")
+        # Parse the whole batch in one call instead of json.loads per event
+        return pa_json.read_json(io.BytesIO(payload), parse_options=options), 0
+    except pa.ArrowInvalid:
+        pass
+    # Only a batch holding a bad record is parsed record by record
+    tables, rejected = [], []
+    for line in payload.splitlines(keepends=True):
+        try:
+            tables.append(pa_json.read_json(io.BytesIO(line), parse_options=options))
+        except pa.ArrowInvalid:
+            rejected.append(line)
+    os.makedirs(os.path.dirname(dead_letter_path), exist_ok=True)
+    tmp_path = f"{dead_letter_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b"".join(rejected))
+    os.replace(tmp_path, dead_letter_path)
+    print(f"Wrote {len(rejected)} unparsable event log record(s) to {dead_letter_path}")
+    events = pa.concat_tables(tables) if tables else STREAM_EVENT_SCHEMA.empty_table()
+    return events, len(rejected)
+
+def process_log_micro_batch(event_log=None, group=LOG_CONSUMER_GROUP, max_records=LOG_MAX_RECORDS, profile=None):
+    """
+    Consumes one micro-batch from the event log: up to `max_records` per partition from the
+    group's committed offsets, one Parquet file per partition named after its start offset.
+    Offsets are committed only after the file is written, so after a crash the next poll starts
+    at the same offset and its file (a superset if events arrived meanwhile) replaces the
+    uncommitted one instead of duplicating rows. Unparsable records are moved to a dead-letter
+    file per partition and start offset (replaced the same way on replay) and skipped.
+    Returns the number of events processed.
+    """
+    os.makedirs(SPEED_OUTPUT, exist_ok=True)
+    log = event_log or EventLog(retention_segments=LOG_RETENTION_SEGMENTS)
+    batches = log.poll(group, max_records)
+    if not batches:
+        return 0
+
+    metrics = get_registry("speed")
+    profiler = Profiler("speed", enabled=profile)
+    batch_start = time.perf_counter()
+    con = duckdb.connect()
+
+    committed = {}
+    event_count = 0
+    for partition, (payload, count, start_offset, next_offset) in sorted(batches.items()):
+        # Named by start offset only: a replay after a crash overwrites the file whatever its end offset
+        output_file = f"speed_log_p{partition}_{start_offset:020d}.parquet"
+        dst = os.path.join(SPEED_OUTPUT, output_file).replace('\\', '/')
+        tmp_path = os.path.join(SPEED_OUTPUT, f".{output_file}.tmp").replace('\\', '/')
+        try:
+            dead_letter_path = os.path.join(DEAD_LETTER_DIR, f"{group}_p{partition}_{start_offset:020d}.ndjson")
+            events, rejected = parse_log_records(payload, dead_letter_path)
+            if events.num_rows == 0:
+                # Nothing left to write; committing moves the group past the bad records
+                committed[partition] = next_offset
+                continue
+            con.register("log_events", events)
+            with profiler.stage("ingest_log_partition") as stage:
+                stage["partition"] = partition
+                rows = profiler.execute(con, f"""
+                    COPY (
+                        SELECT 
+                            * EXCLUDE (timestamp),
+                            CAST(timestamp AS TIMESTAMP) as event_time,
+                            now() as processed_at
+                        FROM log_events
+                    ) TO '{tmp_path}' ({parquet_copy_options()});
+                """)[0][0]
+                stage["rows"] = rows
+            # Rename so a replayed range swaps the uncommitted file in one step
+            os.replace(tmp_path, dst)
+            con.unregister("log_events")
+            with profiler.stage("sketches"):
+                write_sketches(con, f"read_parquet('{dst}')", os.path.join(SPEED_SKETCH_DIR, output_file),
+                               time_col="event_time", execute=profiler.execute)
+            committed[partition] = next_offset
+            event_count += events.num_rows
+
+            with profiler.stage("event_lag"):
+                oldest_event = profiler.execute(con, f"SELECT MIN(event_time) FROM read_parquet('{dst}')")[0][0]
+            metrics.inc("lambda_rows_written_total", rows, layer="speed")
+            if oldest_event is not None:
+                metrics.observe("lambda_event_processing_lag_seconds", event_lag_seconds(oldest_event))
+        except Exception as e:
+            print(f"Error processing partition {partition} from offset {start_offset}: {e}")
+
+    with profiler.stage("checkpoint") as stage:
+        log.commit(group, committed)
+        stage["rows"] = log.enforce_retention()
+
+    metrics.observe("lambda_micro_batch_duration_seconds", time.perf_counter() - batch_start)
+    metrics.set("lambda_last_run_timestamp_seconds", time.time(), layer="speed")
+    metrics.flush()
+    profiler.write_report()
+    return event_count
+
+class SpeedLayerRuntime:
+    """
+    Step-driven streaming loop around `process_stream_micro_batch`.
+    `run_once()` executes one trigger; `run()` repeats it every `trigger_interval` seconds,
+    waking early when `notify()` is called or a new file lands in the stream directory.
+    `stop()` lets the in-flight micro-batch finish (its checkpoint is flushed at the end of
+    every micro-batch), optionally runs one final draining pass, and then returns from `run()`.
+    `clock` is injectable so tests can drive trigger deadlines without real sleeps.
+    """
+
+    def __init__(self, trigger_interval=TRIGGER_INTERVAL_SEC, clock=time.monotonic, watch_interval=WATCH_INTERVAL_SEC, profile=None, source=STREAM_SOURCE):
+        if source not in ("files", "log"):
+            raise ValueError(f"Unknown stream source '{source}', expected 'files' or 'log'")
+        self.source = source
+        self.event_log = EventLog(retention_segments=LOG_RETENTION_SEGMENTS) if source == "log" else None
+        self.trigger_interval = trigger_interval
+        self.clock = clock
+        self.watch_interval = watch_interval
+        self.profile = profile
+        self.batches_run = 0
+        self.files_processed = 0
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._step_lock = threading.Lock()
+        self._drain_on_stop = True
+        self._stream_dir_state = self._stream_dir_mtime()
+
+    def _stream_dir_mtime(self):
+        if self.event_log is not None:
+            return self.event_log.fingerprint()
+        try:
+            return os.stat(STREAM_INPUT).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _new_files_arrived(self):
+        state = self._stream_dir_mtime()
+        if state != self._stream_dir_state:
+            self._stream_dir_state = state
+            return True
+        return False
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run_once(self):
+        """Runs a single micro-batch trigger and returns the number of files (or log events) processed."""
+        with self._step_lock:
+            # Snapshot before listing so files landing mid-batch still wake the next trigger
+            self._stream_dir_state = self._stream_dir_mtime()
+            if self.event_log is not None:
+                count = process_log_micro_batch(self.event_log, profile=self.profile)
+            else:
+                count = process_stream_micro_batch(profile=self.profile)
+        self.batches_run += 1
+        self.files_processed += count
+        if count > 0:
+            unit = "events from the event log" if self.event_log is not None else "new stream files"
+            print(f"Processed {count} {unit}.")
+        return count
+
+    def notify(self):
+        """Wakes the loop immediately, e.g. from an in-process producer that just wrote a file."""
+        self._wake_event.set()
+
+    def wait_for_trigger(self):
+        """Blocks until the trigger interval elapses on `clock`, new input arrives, or stop is requested."""
+        deadline = self.clock() + self.trigger_interval
+        while not self._stop_event.is_set():
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return
+            if self._wake_event.wait(min(self.watch_interval, remaining)):
+                self._wake_event.clear()
+                return
+            if self._new_files_arrived():
+                return
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.run_once()
+            self.wait_for_trigger()
+        if self._drain_on_stop:
+            # Pick up anything that landed between the last trigger and the stop request
+            self.run_once()
+        print("Speed Layer stopped cleanly.")
+
+    def stop(self, drain=True):
+        self._drain_on_stop = drain
+        self._stop_event.set()
+        self._wake_event.set()
+
+def process_stream(trigger_interval=TRIGGER_INTERVAL_SEC, source=STREAM_SOURCE):
+    print(f"Starting Speed Layer (Micro-batch simulation via DuckDB, source={source})...")
+    runtime = SpeedLayerRuntime(trigger_interval=trigger_interval, source=source)
+    if threading.current_thread() is threading.main_thread():
+        # Ctrl+C and orchestrator shutdowns (SIGTERM) both stop the loop between micro-batches, so the
+        # running one finishes and checkpoints instead of being interrupted, and then drain
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: runtime.stop())
+    runtime.run()
+    return runtime
 
 if __name__ == "__main__":
     process_stream()
@@ -6,6 +6,7 @@ import time
 import threading
 import sys
 import pandas as pd
+import pyarrow.parquet as pq
 from datetime import datetime, timedelta
 
 # No longer need Spark monkeypatch as we switched to DuckDB
@@ -20,10 +21,15 @@ os.environ["LAMBDA_BASE_DIR"] = TEST_DIR
 
 # Now import modules
 sys.path.append(os.getcwd())
-from data_generator.generate_data import generate_users, generate_batch_history, generate_stream_event, simulate_streaming
-from batch_layer.process_batch import process_batch
-from speed_layer.process_stream import process_stream
+from data_generator.generate_data import generate_users, generate_user_updates, generate_batch_history, generate_stream_event, generate_stream_events, simulate_streaming, stream_to_server
+from batch_layer.process_batch import process_batch, backfill, refresh_user_enrichment, current_generation
+from speed_layer.process_stream import process_stream_micro_batch, process_log_micro_batch, SpeedLayerRuntime
+from event_bus.event_log import EventLog
+from speed_layer.ingest_server import IngestServer
 from serving_layer.query_engine import ServingLayer
+from monitoring.metrics import MetricsRegistry, render_prometheus, summarize
+from monitoring.profiling import compare_reports, list_reports, load_report, top_operators
+from common.storage import parquet_copy_options
 
 class TestLambdaPlatform(unittest.TestCase):
     
@@ -42,22 +48,25 @@ class TestLambdaPlatform(unittest.TestCase):
     
     def test_01_gen_users_schema(self):
         generate_users()
-        users_path = os.path.join(TEST_DIR, "data", "master", "users.csv")
+        users_path = os.path.join(TEST_DIR, "data", "master", "users.parquet")
         self.assertTrue(os.path.exists(users_path))
-        df = pd.read_csv(users_path)
+        schema = pq.read_schema(users_path)
         expected_cols = ['user_id', 'name', 'region', 'signup_date']
-        self.assertListEqual(list(df.columns), expected_cols)
+        self.assertListEqual(schema.names, expected_cols)
+        self.assertEqual(str(schema.field('user_id').type), 'int64')
+        self.assertEqual(str(schema.field('signup_date').type), 'date32[day]')
 
     def test_02_gen_users_region(self):
-        users_path = os.path.join(TEST_DIR, "data", "master", "users.csv")
-        df = pd.read_csv(users_path)
+        users_path = os.path.join(TEST_DIR, "data", "master", "users.parquet")
+        df = pd.read_parquet(users_path)
         valid_regions = ['US', 'EU', 'APAC', 'LATAM']
         self.assertTrue(df['region'].isin(valid_regions).all())
         
     def test_03_gen_users_unique(self):
-        users_path = os.path.join(TEST_DIR, "data", "master", "users.csv")
-        df = pd.read_csv(users_path)
+        users_path = os.path.join(TEST_DIR, "data", "master", "users.parquet")
+        df = pd.read_parquet(users_path)
         self.assertTrue(df['user_id'].is_unique)
+        self.assertEqual(len(df), 1000)
 
     def test_04_gen_batch_schema(self):
         generate_batch_history(num_records=10)
@@ -111,8 +120,8 @@ class TestLambdaPlatform(unittest.TestCase):
              generate_batch_history(100)
         process_batch()
         # Check success by output existence (Spark logs are noisy, we assume no exception = success)
-        out_dir = os.path.join(TEST_DIR, "data", "processed", "batch_views")
-        self.assertTrue(os.path.exists(out_dir))
+        out_dir = current_generation()
+        self.assertTrue(out_dir and os.path.exists(out_dir))
         # Check generic parquet files exist
         self.assertTrue(any(f.endswith(".parquet") for f in os.listdir(out_dir)))
 
@@ -158,55 +167,419 @@ class TestLambdaPlatform(unittest.TestCase):
         df = sl.get_unified_view()
         self.assertTrue('processed_at' in df.columns)
 
+    def test_15a_batch_user_upserts(self):
+        before = pd.read_parquet(current_generation())
+        changed = [int(u) for u in before['user_id'].drop_duplicates().head(3)]
+        update_path = generate_user_updates(user_ids=changed, new_user_rate=0)
+        upserts = pd.read_parquet(update_path).set_index('user_id')
+
+        expected_rows = int(before['user_id'].isin(changed).sum())
+        published = current_generation()
+        self.assertEqual(refresh_user_enrichment(), expected_rows)
+        after = pd.read_parquet(current_generation())
+        # Files without a changed user are carried over (hard-linked), not rewritten
+        for name in sorted(f for f in os.listdir(published) if f.endswith(".parquet")):
+            has_changed = pd.read_parquet(os.path.join(published, name), columns=['user_id'])['user_id'].isin(changed).any()
+            same_file = os.path.samefile(os.path.join(published, name), os.path.join(current_generation(), name))
+            self.assertEqual(same_file, not has_changed)
+        self.assertEqual(len(after), len(before))
+        for user_id in changed:
+            rows = after[after['user_id'] == user_id]
+            self.assertTrue((rows['user_name'] == upserts.loc[user_id, 'name']).all())
+            self.assertTrue((rows['region'] == upserts.loc[user_id, 'region']).all())
+        untouched = after[~after['user_id'].isin(changed)].sort_values('transaction_id')['user_name'].tolist()
+        self.assertEqual(untouched, before[~before['user_id'].isin(changed)].sort_values('transaction_id')['user_name'].tolist())
+
+        # Applied upserts are checkpointed; a full rebuild keeps them
+        self.assertEqual(refresh_user_enrichment(), 0)
+        process_batch()
+        rebuilt = pd.read_parquet(current_generation())
+        self.assertTrue((rebuilt[rebuilt['user_id'] == changed[0]]['user_name'] == upserts.loc[changed[0], 'name']).all())
+
+        # New users in successive upsert files get fresh ids, above every existing user
+        users_path = os.path.join(TEST_DIR, "data", "master", "users.parquet")
+        master_max = int(pd.read_parquet(users_path)['user_id'].max())
+        first = pd.read_parquet(generate_user_updates(user_ids=changed, new_user_rate=1.0))['user_id']
+        second = pd.read_parquet(generate_user_updates(user_ids=changed, new_user_rate=1.0))['user_id']
+        first_new, second_new = set(first) - set(changed), set(second) - set(changed)
+        self.assertEqual(len(first_new), len(changed))
+        self.assertGreater(min(first_new), master_max)
+        self.assertGreater(min(second_new), max(first_new))
+
+    def test_15b_batch_backfill_partitions(self):
+        out_dir = current_generation()
+        partitions = sorted(f for f in os.listdir(out_dir) if f.endswith(".parquet"))
+        self.assertIn("batch_data_2023-01-01.parquet", partitions)
+        mtimes = {f: os.path.getmtime(os.path.join(out_dir, f)) for f in partitions}
+
+        # Nothing changed: a backfill rebuilds no partitions
+        self.assertEqual(backfill(), [])
+
+        # A correction moving DUP_1 to another day rebuilds exactly the two affected dates, in the pool
+        correction = os.path.join(TEST_DIR, "data", "raw", "batch", "corrections.json")
+        with open(correction, 'w') as f:
+            f.write(json.dumps({"transaction_id": "DUP_1", "user_id": 1, "product": "Mouse", "amount": 12, "timestamp": "2023-01-02 09:00:00", "status": "C"}) + "\n")
+        self.assertEqual(backfill(workers=2, memory_limit="256MB"), ["2023-01-01", "2023-01-02"])
+        out_dir = current_generation()
+        df = pd.read_parquet(out_dir)
+        self.assertEqual(len(df[df['transaction_id'] == 'DUP_1']), 1)
+        self.assertEqual(df[df['transaction_id'] == 'DUP_1'].iloc[0]['amount'], 12)
+        self.assertFalse(os.path.exists(os.path.join(out_dir, "batch_data_2023-01-01.parquet")))
+        for f in partitions:
+            if f != "batch_data_2023-01-01.parquet":
+                self.assertEqual(os.path.getmtime(os.path.join(out_dir, f)), mtimes[f])
+
+        # An explicit range rebuilds those dates even when unchanged
+        os.remove(correction)
+        self.assertEqual(backfill(start="2023-01-01", end="2023-01-02"), ["2023-01-01", "2023-01-02"])
+        out_dir = current_generation()
+        self.assertTrue(os.path.exists(os.path.join(out_dir, "batch_data_2023-01-01.parquet")))
+        self.assertFalse(os.path.exists(os.path.join(out_dir, "batch_data_2023-01-02.parquet")))
+
+        # A range covering only the source day of a move leaves the (existing) target day stale; the
+        # next changed-only backfill must still rebuild it rather than trust the range run's fingerprints
+        target = sorted(f for f in partitions if f.startswith("batch_data_20") and f != "batch_data_2023-01-01.parquet")[0][len("batch_data_"):-len(".parquet")]
+        with open(correction, 'w') as f:
+            f.write(json.dumps({"transaction_id": "DUP_1", "user_id": 1, "product": "Mouse", "amount": 12, "timestamp": f"{target} 09:00:00", "status": "C"}) + "\n")
+        self.assertEqual(backfill(start="2023-01-01", end="2023-01-01"), ["2023-01-01"])
+        self.assertEqual(backfill(), [target])
+        df = pd.read_parquet(current_generation())
+        self.assertEqual(df[df['transaction_id'] == 'DUP_1']['amount'].tolist(), [12])
+        os.remove(correction)
+        self.assertEqual(backfill(), ["2023-01-01", target])
+
+    def test_15c_batch_generation_swap(self):
+        import batch_layer.process_batch as pb
+        published = current_generation()
+        before = pd.read_parquet(published)
+
+        # A run failing after its partitions are built publishes nothing and leaves no generation behind
+        def failing_index(con, output_dir, execute=None):
+            raise RuntimeError("index write failed")
+        original = pb.write_txid_index
+        pb.write_txid_index = failing_index
+        try:
+            with self.assertRaises(RuntimeError):
+                backfill(start="2023-01-01", end="2023-01-01")
+        finally:
+            pb.write_txid_index = original
+        self.assertEqual(current_generation(), published)
+        self.assertEqual(len(pd.read_parquet(published)), len(before))
+        generations = lambda: sorted(d for d in os.listdir(pb.BATCH_VIEW_DIR) if d.startswith(pb.GENERATION_PREFIX))
+        self.assertEqual(generations()[-1], os.path.basename(published))
+
+        # Each run publishes a new generation; the one it replaced stays for running queries, older ones go
+        backfill(start="2023-01-01", end="2023-01-01")
+        second = current_generation()
+        self.assertNotEqual(second, published)
+        self.assertIn(os.path.basename(published), generations())
+        backfill(start="2023-01-01", end="2023-01-01")
+        self.assertEqual(generations(), [os.path.basename(second), os.path.basename(current_generation())])
+        self.assertEqual(len(pd.read_parquet(current_generation())), len(before))
+
+        # Runs are serialized: one started while another holds the lock waits for it
+        third = current_generation()
+        with pb.batch_view_lock():
+            worker = threading.Thread(target=backfill, kwargs={"start": "2023-01-01", "end": "2023-01-01"})
+            worker.start()
+            worker.join(timeout=1.0)
+            self.assertTrue(worker.is_alive())
+            self.assertEqual(current_generation(), third)
+        worker.join()
+        self.assertNotEqual(current_generation(), third)
+
     # --- Speed Layer Tests ---
     
     def test_16_speed_setup(self):
-        # We really can't test long running streaming easily in unit tests without threading
-        # We'll use a short burst strategy managed by the function if possible,
-        # but process_stream() blocks.
-        # We will skip direct blocking calls and test the output artifacts or helper functions if refactored.
-        # Since we cannot easily "unit test" a blocking Spark stream without timeout wrapper,
-        # we will rely on artifacts created by `test_17_speed_execution` which runs it in a thread.
-        pass
+        # A trigger with no new input is a no-op and leaves the runtime stoppable
+        runtime = SpeedLayerRuntime(trigger_interval=0.1)
+        runtime.run_once()
+        self.assertEqual(runtime.run_once(), 0)
+        self.assertEqual(runtime.batches_run, 2)
 
     def test_17_speed_execution(self):
-        # Run streaming in a separate thread for 10 seconds, generate data, then stop
-        stream_thread = threading.Thread(target=process_stream)
-        stream_thread.daemon = True # Daemon so it dies if set fails
+        # Run the streaming runtime in a thread, generate data, then stop and drain
+        runtime = SpeedLayerRuntime(trigger_interval=0.5, watch_interval=0.05)
+        stream_thread = threading.Thread(target=runtime.run)
         stream_thread.start()
-        
-        # Give it time to start up
-        time.sleep(10) 
-        
-        # Gen data
-        simulate_streaming(interval_sec=1, duration_sec=5)
-        
-        # Give it time to process
-        time.sleep(15) 
-        
-        # Stop is hard without refactor (exception in stream loop), 
-        # but we can check if files appeared in processed/speed_views
+
+        simulate_streaming(interval_sec=0.2, duration_sec=1)
+
+        runtime.stop()
+        stream_thread.join(timeout=10)
+        self.assertFalse(stream_thread.is_alive())
+
         out_dir = os.path.join(TEST_DIR, "data", "processed", "speed_views")
         self.assertTrue(os.path.exists(out_dir))
-        # It's possible it's empty if no trigger fired yet, but 15s should be enough for 5s trigger.
-        files = [f for f in os.listdir(out_dir) if f.endswith('.parquet')]
-        # Stream creates folders sometimes.
-        # Check deep walk
         has_parquet = False
         for root, dirs, files in os.walk(out_dir):
             for file in files:
                 if file.endswith(".parquet"):
                     has_parquet = True
-        
-        if not has_parquet:
-            # Maybe it needs more time on slow env, but let's assert what we can
-            print("Warning: Speed layer output not found in time, might be environmental latency used in test.")
-        else:
-            self.assertTrue(has_parquet)
-        
-        # We can't kill the thread safely without shared state flag in process_stream.
-        # Python threads are non-killable. This test leaks a thread/process usually.
-        # For this logic check, we proceed.
+        self.assertTrue(has_parquet)
+
+        # The drain pass checkpointed every dropped file exactly once
+        stream_dir = os.path.join(TEST_DIR, "data", "raw", "stream")
+        with open(os.path.join(TEST_DIR, "data", "speed_checkpoint.txt"), 'r') as f:
+            checkpointed = [line.strip() for line in f if line.strip()]
+        self.assertEqual(len(checkpointed), len(set(checkpointed)))
+        self.assertTrue(set(os.listdir(stream_dir)).issubset(set(checkpointed)))
+
+    def test_18_speed_wakes_on_new_files(self):
+        # A long trigger interval must not delay files that have already arrived
+        runtime = SpeedLayerRuntime(trigger_interval=60, watch_interval=0.05)
+        stream_thread = threading.Thread(target=runtime.run)
+        stream_thread.start()
+        time.sleep(0.2)
+        processed_before = runtime.files_processed
+        simulate_streaming(interval_sec=0, duration_sec=0.01)
+        deadline = time.time() + 5
+        while runtime.files_processed == processed_before and time.time() < deadline:
+            time.sleep(0.05)
+        runtime.stop(drain=False)
+        stream_thread.join(timeout=10)
+        self.assertGreater(runtime.files_processed, processed_before)
+
+    def test_19_speed_injectable_clock(self):
+        # Each clock read jumps past the trigger deadline, so triggers fire without sleeping
+        fake_now = [0.0]
+        def clock():
+            fake_now[0] += 10
+            return fake_now[0]
+        runtime = SpeedLayerRuntime(trigger_interval=5, clock=clock)
+        stream_thread = threading.Thread(target=runtime.run)
+        stream_thread.start()
+        deadline = time.time() + 5
+        while runtime.batches_run < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        runtime.stop(drain=False)
+        stream_thread.join(timeout=10)
+        self.assertGreaterEqual(runtime.batches_run, 3)
+
+    def test_20_event_log_offsets_and_segments(self):
+        log = EventLog(topic="unit_log", num_partitions=2, segment_max_bytes=4096, index_interval=16)
+        events = [dict(generate_stream_event(), transaction_id=f"LOG_{i}") for i in range(2000)]
+        log.append(events)
+        self.assertEqual(sum(log.end_offsets().values()), 2000)
+        self.assertTrue(len(log.partitions[0].segments()) > 1)
+
+        # Seeking into the middle of a later segment returns exactly the records from that offset
+        payload, count, next_offset = log.read(0, 500, max_records=300)
+        self.assertEqual(count, 300)
+        self.assertEqual(next_offset, 800)
+        everything, _, _ = log.read(0, 0, max_records=5000)
+        self.assertEqual(payload.splitlines(), everything.splitlines()[500:800])
+
+        # Retention keeps unconsumed segments until the group commits past them
+        log.retention_segments = 1
+        log.commit("unit", {0: 0, 1: 0})
+        self.assertEqual(log.enforce_retention(), 0)
+        log.commit("unit", log.end_offsets())
+        self.assertTrue(log.enforce_retention() > 0)
+        self.assertEqual(len(log.partitions[0].segments()), 1)
+
+    def test_20a_speed_consumes_event_log(self):
+        simulate_streaming(interval_sec=0, duration_sec=0.05, sink="log")
+        log = EventLog()
+        produced = sum(log.end_offsets().values())
+        self.assertTrue(produced > 0)
+        self.assertEqual(process_log_micro_batch(log), produced)
+        self.assertEqual(log.committed("speed_layer"), log.end_offsets())
+        # Nothing new: the consumer group resumes from its committed offsets
+        self.assertEqual(process_log_micro_batch(log), 0)
+        out_dir = os.path.join(TEST_DIR, "data", "processed", "speed_views")
+        self.assertTrue(any(f.startswith("speed_log_p") for f in os.listdir(out_dir)))
+
+    def test_20b_ingest_server_flush(self):
+        out_dir = os.path.join(TEST_DIR, "data", "processed", "speed_views")
+        def ingested_rows():
+            files = [os.path.join(out_dir, f) for f in os.listdir(out_dir) if f.startswith("speed_ingest_")]
+            return sum(pd.read_parquet(f).shape[0] for f in files)
+
+        server = IngestServer(port=0, max_rows=200, max_latency=0.2)
+        thread = server.start_in_thread()
+        host, port = server.address
+
+        # Time-based flush: a handful of events (plus one malformed line) become queryable well under a second
+        import socket
+        with socket.create_connection((host, port)) as sock:
+            payload = "".join(json.dumps(generate_stream_event()) + "\n" for _ in range(3)) + "{not json\n"
+            sock.sendall(payload.encode("utf-8"))
+        deadline = time.time() + 2
+        while ingested_rows() < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(ingested_rows(), 3)
+        self.assertEqual(server.events_rejected, 1)
+
+        # Size-based flush under load from the generator's client
+        sent = stream_to_server(duration_sec=0.5, events_per_sec=2000, host=host, port=port)
+        server.stop()
+        thread.join(timeout=10)
+        self.assertEqual(ingested_rows(), sent + 3)
+        self.assertGreater(server.files_written, sent // 200)
+
+        # Ingested files are unioned by the serving layer like any speed view
+        df = ServingLayer().get_unified_view()
+        self.assertTrue(df['transaction_id'].str.startswith('stream_').sum() >= sent + 3)
+
+    def test_20c_speed_arrow_drop_files(self):
+        simulate_streaming(interval_sec=0, duration_sec=0.01, fmt="arrow")
+        stream_dir = os.path.join(TEST_DIR, "data", "raw", "stream")
+        arrow_files = [f for f in os.listdir(stream_dir) if f.endswith(".arrow")]
+        self.assertTrue(len(arrow_files) > 0)
+        SpeedLayerRuntime(trigger_interval=0.1).run_once()
+
+        # Arrow- and JSON-sourced speed views share one schema, so the serving union is unaffected
+        out_dir = os.path.join(TEST_DIR, "data", "processed", "speed_views")
+        arrow_out = pd.read_parquet(os.path.join(out_dir, f"speed_{arrow_files[0][:-len('.arrow')]}.parquet"))
+        json_stems = [f[:-len('.json')] for f in os.listdir(stream_dir) if f.endswith(".json")]
+        json_out = pd.read_parquet(os.path.join(out_dir, f"speed_{json_stems[0]}.parquet"))
+        self.assertListEqual(list(arrow_out.columns), list(json_out.columns))
+        self.assertEqual(dict(arrow_out.dtypes), dict(json_out.dtypes))
+        self.assertTrue((arrow_out['status'] == 'PENDING').all())
+
+    def test_20d_view_storage_layout(self):
+        # Every speed view file (micro-batch or ingest server) has one typed event_time and the same schema
+        speed_dir = os.path.join(TEST_DIR, "data", "processed", "speed_views")
+        speed_files = [os.path.join(speed_dir, f) for f in os.listdir(speed_dir) if f.endswith(".parquet")]
+        schemas = {tuple((f.name, str(f.type)) for f in pq.read_schema(path)) for path in speed_files}
+        self.assertEqual(len(schemas), 1)
+        names = [name for name, _ in schemas.pop()]
+        self.assertNotIn("timestamp", names)
+        self.assertIn("event_time", names)
+
+        # Views are ZSTD-compressed; the ingest server's pyarrow writer dictionary-encodes only the categoricals
+        # (DuckDB decides per column and skips dictionaries for the test suite's tiny partitions)
+        batch_dir = current_generation()
+        batch_file = sorted(f for f in os.listdir(batch_dir) if f.endswith(".parquet"))[0]
+        ingest_file = sorted(f for f in os.listdir(speed_dir) if f.startswith("speed_ingest_"))[-1]
+        for path in (os.path.join(batch_dir, batch_file), os.path.join(speed_dir, ingest_file)):
+            meta = pq.ParquetFile(path).metadata.row_group(0)
+            self.assertTrue(all(meta.column(i).compression == "ZSTD" for i in range(meta.num_columns)))
+        meta = pq.ParquetFile(os.path.join(speed_dir, ingest_file)).metadata.row_group(0)
+        encodings = {meta.column(i).path_in_schema: meta.column(i).encodings for i in range(meta.num_columns)}
+        self.assertTrue(any("DICTIONARY" in e for e in encodings["product"]))
+        self.assertFalse(any("DICTIONARY" in e for e in encodings["transaction_id"]))
+
+        self.assertIn("DICTIONARY_SIZE_LIMIT 0", parquet_copy_options(dictionary=False))
+        self.assertNotIn("COMPRESSION_LEVEL", parquet_copy_options(compression="snappy"))
+        with self.assertRaises(ValueError):
+            parquet_copy_options(compression="xz")
+
+    def test_20e_speed_event_log_replay_after_crash(self):
+        class CrashingLog(EventLog):
+            def commit(self, group, offsets):
+                raise OSError("crash before commit")
+
+        log = EventLog()
+        start = log.committed("speed_layer")
+        log.append([generate_stream_event() for _ in range(100)])
+        with self.assertRaises(OSError):
+            process_log_micro_batch(CrashingLog())
+
+        # More events arrive before the restart: the replay reads from the same offsets and
+        # replaces each uncommitted file with a superset instead of adding a second one
+        log.append([generate_stream_event() for _ in range(50)])
+        self.assertEqual(process_log_micro_batch(log), 150)
+        out_dir = os.path.join(TEST_DIR, "data", "processed", "speed_views")
+        new_files = [
+            f for f in os.listdir(out_dir)
+            if f.startswith("speed_log_p") and int(f[:-len(".parquet")].split("_")[3]) >= start[int(f.split("_")[2][1:])]
+        ]
+        df = pd.concat(pd.read_parquet(os.path.join(out_dir, f)) for f in new_files)
+        self.assertEqual(len(df), 150)
+        # One file per partition: the pre-crash files were overwritten, not joined by a second one
+        self.assertEqual(len(new_files), len({f.split("_")[2] for f in new_files}))
+
+    def test_20f_ingest_invalid_lines_and_failed_flush(self):
+        # Flushes fail while the output dir can't be created; events must stay buffered, not vanish
+        blocker = os.path.join(TEST_DIR, "ingest_blocker")
+        with open(blocker, 'w') as f:
+            f.write("not a directory")
+        server = IngestServer(port=0, max_rows=10000, max_latency=0.1, output_dir=os.path.join(blocker, "views"))
+        thread = server.start_in_thread()
+        host, port = server.address
+
+        good = generate_stream_event()
+        iso = dict(generate_stream_event(), timestamp="2024-05-01T10:00:00")
+        lines = [json.dumps(good), "[1, 2]", json.dumps(dict(good, user_id="abc")), json.dumps(iso), "{not json"]
+        import socket
+        with socket.create_connection((host, port)) as sock:
+            sock.sendall(("\n".join(lines) + "\n").encode("utf-8"))
+        deadline = time.time() + 2
+        while server.events_received + server.events_rejected < len(lines) and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.3)  # several timer flushes fail meanwhile
+        self.assertEqual((server.events_received, server.events_rejected, server.files_written), (2, 3, 0))
+
+        # Once writes succeed again the timer (still running) flushes the kept rows
+        out_dir = os.path.join(TEST_DIR, "ingest_retry")
+        server.output_dir = out_dir
+        deadline = time.time() + 2
+        while server.files_written == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        server.stop()
+        thread.join(timeout=10)
+        df = pd.concat(pd.read_parquet(os.path.join(out_dir, f)) for f in os.listdir(out_dir))
+        self.assertEqual(sorted(df['transaction_id']), sorted([good['transaction_id'], iso['transaction_id']]))
+        self.assertEqual(df['event_time'].isna().sum(), 0)
+        self.assertIn(pd.Timestamp("2024-05-01 10:00:00"), list(df['event_time']))
+
+    def test_20g_event_log_torn_record_and_dead_letter(self):
+        root = os.path.join(TEST_DIR, "torn_log")
+        log = EventLog(topic="torn", root=root, num_partitions=1)
+        log.append([dict(generate_stream_event(), transaction_id=f"TORN_{i}") for i in range(3)])
+        part = log.partitions[0]
+        with open(part._log_path(part.segments()[-1]), 'ab') as f:
+            f.write(b'{"transaction_id":"TORN_half')  # Producer crashed mid-write
+
+        # Readers stop before the torn record; a restarted producer cuts it off before appending
+        self.assertEqual(log.read(0, 0)[1], 3)
+        restarted = EventLog(topic="torn", root=root)
+        restarted.append([dict(generate_stream_event(), transaction_id="TORN_3")])
+        payload, count, _ = restarted.read(0, 0)
+        self.assertEqual(count, 4)
+        self.assertEqual([json.loads(line)["transaction_id"] for line in payload.splitlines()], [f"TORN_{i}" for i in range(4)])
+
+        # Records that do not parse go to a dead-letter file; the rest of the partition is processed
+        log = EventLog()
+        start = log.committed("speed_layer")
+        partition = log.partition_for(1)
+        log.partitions[partition].append([b'{not json\n', (json.dumps(dict(generate_stream_event(), user_id="abc")) + "\n").encode()])
+        log.append([dict(generate_stream_event(), user_id=1)])
+        self.assertEqual(process_log_micro_batch(log), 1)
+        self.assertEqual(log.committed("speed_layer"), log.end_offsets())
+        dead_letter = os.path.join(TEST_DIR, "data", "dead_letter", f"speed_layer_p{partition}_{start[partition]:020d}.ndjson")
+        with open(dead_letter, 'rb') as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+
+    def test_20h_ingest_oversized_line_and_failed_final_flush(self):
+        import socket
+        import speed_layer.ingest_server as ingest_server
+        blocker = os.path.join(TEST_DIR, "ingest_blocker")
+        with open(blocker, 'w') as f:
+            f.write("not a directory")
+        server = IngestServer(port=0, max_latency=60, output_dir=os.path.join(blocker, "views"), max_line_bytes=1024)
+        thread = server.start_in_thread()
+        host, port = server.address
+
+        # A client streaming bytes without newlines is cut off instead of growing its buffer
+        with socket.create_connection((host, port)) as sock:
+            sock.sendall((json.dumps(generate_stream_event()) + "\n").encode("utf-8") + b"x" * 4096)
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(1), b"")
+        self.assertEqual((server.events_received, server.events_rejected), (1, 1))
+
+        # A shutdown flush that keeps failing is retried, then its rows are counted as dropped
+        original = ingest_server.FINAL_FLUSH_RETRY_SEC
+        ingest_server.FINAL_FLUSH_RETRY_SEC = 0.01
+        try:
+            server.stop()
+            thread.join(timeout=10)
+        finally:
+            ingest_server.FINAL_FLUSH_RETRY_SEC = original
+        self.assertFalse(thread.is_alive())
+        self.assertEqual((server.files_written, server.events_dropped), (0, 1))
 
     # --- Serving Layer Tests ---
 
@@ -241,6 +614,265 @@ class TestLambdaPlatform(unittest.TestCase):
         t2 = recent.iloc[1]['timestamp']
         self.assertTrue(t1 >= t2)
 
+    def test_28_serving_transaction_lookup(self):
+        generate_batch_history(5000)
+        # One busy day with more rows than a row group: DuckDB honours row group sizes from 2048 rows up
+        busy = os.path.join(TEST_DIR, "data", "raw", "batch", "busy_day.json")
+        with open(busy, 'w') as f:
+            for i in range(5000):
+                f.write(json.dumps({"transaction_id": f"BUSY_{i:05d}", "user_id": i % 100 + 1, "product": "Mouse", "amount": 10, "timestamp": "2022-06-01 12:00:00", "status": "C"}) + "\n")
+        # Two workers: the row group size must reach the pool processes, not just this one
+        process_batch(workers=2, row_group_size=2048)
+        os.remove(busy)
+
+        with open(os.path.join(current_generation(), "_txid_index.json")) as f:
+            index = json.load(f)
+        busy_groups = index["files"]["batch_data_2022-06-01.parquet"]["row_groups"]
+        self.assertEqual([n for _, n, _, _ in busy_groups], [2048, 2048, 904])
+        self.assertGreater(len(index["files"]), 1)
+
+        sl = ServingLayer()
+        tx_id = "BUSY_02500"
+        # Partitions are sorted: within each file id ranges are disjoint, so exactly one row group of the
+        # busy day (its second) and at most one of any other file can hold the id
+        self.assertEqual([rg for rg, _, lo, hi in busy_groups if lo <= tx_id <= hi], [1])
+        for entry in index["files"].values():
+            self.assertLessEqual(sum(1 for _, _, lo, hi in entry["row_groups"] if lo <= tx_id <= hi), 1)
+        # The global id map narrows a lookup to the single date partition holding the id
+        self.assertEqual(len(sl._batch_files_for(tx_id)), 1)
+        self.assertEqual(sl._batch_files_for("NO_SUCH_TX"), [])
+        match = sl.get_transaction(tx_id)
+        self.assertEqual(len(match), 1)
+        self.assertEqual(match.iloc[0]['layer'], 'batch')
+        self.assertTrue(sl.get_transaction("NO_SUCH_TX").empty)
+
+    def test_29_serving_sketches(self):
+        sl = ServingLayer()
+        df = sl.get_unified_view()
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        exact_users = df['user_id'].nunique()
+        self.assertAlmostEqual(sl.get_distinct_users(), exact_users, delta=max(3, exact_users * 0.05))
+
+        percentiles = sl.get_amount_percentiles()
+        self.assertEqual(set(percentiles), {"p50", "p95"})
+        for q, key in ((0.5, "p50"), (0.95, "p95")):
+            exact = df['amount'].quantile(q)
+            self.assertAlmostEqual(percentiles[key], exact, delta=exact * 0.03)
+
+        # Hour-aligned range: only sketches of hours before `end` are merged
+        end = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=2)
+        older = df[df['timestamp'] < end]
+        self.assertAlmostEqual(sl.get_distinct_users(end=end), older['user_id'].nunique(), delta=max(3, older['user_id'].nunique() * 0.05))
+        self.assertFalse(older.empty)
+        self.assertEqual(sl.get_distinct_users(start=datetime.now() + timedelta(days=1)), 0)
+        self.assertIsNone(sl.get_amount_percentiles(start=datetime.now() + timedelta(days=1))["p50"])
+
+    def test_29a_serving_export(self):
+        sl = ServingLayer()
+        df = sl.get_unified_view()
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        export_dir = os.path.join(TEST_DIR, "exports")
+
+        # Parquet, membership filters across both layers
+        out = os.path.join(export_dir, "laptops.parquet")
+        rows = sl.export(out, products=["Laptop", "Mouse"], statuses=["COMPLETED", "PENDING"])
+        expected = df[df['product'].isin(["Laptop", "Mouse"]) & df['status'].isin(["COMPLETED", "PENDING"])]
+        self.assertEqual(rows, len(expected))
+        self.assertEqual(len(pd.read_parquet(out)), len(expected))
+
+        # CSV, time range and region (speed rows carry no region); progress ends at 100%
+        end = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=2)
+        seen = []
+        out = os.path.join(export_dir, "eu.csv")
+        rows = sl.export(out, end=end, regions=["EU"], progress=seen.append, poll_interval=0.01)
+        expected = df[(df['timestamp'] < end) & (df['region'] == "EU")]
+        self.assertEqual(rows, len(expected))
+        self.assertEqual(len(pd.read_csv(out)), len(expected))
+        self.assertEqual(seen[-1], 100.0)
+        self.assertFalse(any(f.endswith(".tmp") for f in os.listdir(export_dir)))
+
+        with self.assertRaises(ValueError):
+            sl.export(os.path.join(export_dir, "out.xlsx"))
+
+    def test_29b_serving_query_stats(self):
+        sl = ServingLayer(slow_query_threshold=0.0)
+        view = sl.get_unified_view()
+        sl.get_unified_view()
+        sl.get_kpis()
+
+        # Full unified views are never cached
+        stats = sl.get_query_stats().set_index("query")
+        self.assertEqual(stats.loc["unified_view", "count"], 3)
+        self.assertEqual(stats.loc["unified_view", "cache_hits"], 0)
+        self.assertGreater(stats.loc["unified_view", "avg_files_scanned"], 0)
+        self.assertEqual(stats.loc["kpis", "cache_hits"], 0)
+        self.assertEqual(stats.loc["kpis", "avg_rows"], 1)
+        self.assertLessEqual(stats.loc["unified_view", "p50_seconds"], stats.loc["unified_view", "p99_seconds"])
+
+        tx_id = view.query("user_name.notna()").iloc[0]['transaction_id']
+        first = sl.get_transaction(tx_id)
+        first['amount'] = 0.0  # callers may mutate what they get back; the cached copy is unaffected
+        second = sl.get_transaction(tx_id)
+        self.assertGreater(second['amount'].sum(), 0)
+        self.assertEqual(sl.get_query_stats().set_index("query").loc["get_transaction", "cache_hits"], 1)
+
+        # A changed view file invalidates the cached result, which is replaced rather than kept beside it
+        batch_path = sl._batch_files_for(tx_id)[0]
+        os.utime(batch_path, ns=(time.time_ns(), time.time_ns()))
+        sl.get_transaction(tx_id)
+        self.assertEqual(sl.get_query_stats().set_index("query").loc["get_transaction", "cache_hits"], 1)
+        self.assertEqual(sum(1 for key in sl._cache if key[0] == "get_transaction"), 1)
+        sl.get_transaction(tx_id)
+        self.assertEqual(sl.get_query_stats().set_index("query").loc["get_transaction", "cache_hits"], 2)
+        # The id map lookup behind get_transaction is a recorded (and cached) query of its own
+        lookups = sl.get_query_stats().set_index("query").loc["txid_map_lookup"]
+        self.assertEqual(lookups["count"], 5)
+        self.assertEqual(lookups["cache_hits"], 4)
+
+        # Every executed query was over the zero threshold: logged with its profile, cache hits were not
+        with open(os.path.join(TEST_DIR, "data", "logs", "serving_queries.log")) as f:
+            log = f.read()
+        self.assertEqual(log.count("slow query shape=unified_view"), 3)
+        self.assertEqual(log.count("slow query shape=get_transaction"), 2)
+        self.assertEqual(log.count("slow query shape=txid_map_lookup"), 1)
+        self.assertIn("slow query shape=kpis", log)
+        self.assertIn("SQL: SELECT", log)
+        self.assertIn("profile latency=", log)
+        self.assertIn("READ_PARQUET", log)
+        self.assertNotIn("EXPLAIN", log)
+
+    # --- Monitoring Tests ---
+
+    def test_30_metrics_prometheus_file(self):
+        sl = ServingLayer()
+        sl.get_kpis()
+        # Query metrics go out on a timer; the freshness gauge is set before the query is recorded
+        sl.flush_metrics()
+        prom_path = os.path.join(TEST_DIR, "data", "metrics", "metrics.prom")
+        self.assertTrue(os.path.exists(prom_path))
+        with open(prom_path, 'r') as f:
+            text = f.read()
+        self.assertIn('lambda_events_generated_total{job="generator",source="batch"}', text)
+        self.assertIn('lambda_rows_written_total{job="batch",layer="batch"}', text)
+        self.assertIn('# TYPE lambda_serving_query_duration_seconds histogram', text)
+        self.assertIn('lambda_batch_job_duration_seconds_count{job="batch"}', text)
+        self.assertIn('lambda_data_freshness_seconds{job="serving"}', text)
+
+    def test_31_metrics_histogram_summary(self):
+        reg = MetricsRegistry("unit_test")
+        for value in (0.01, 0.02, 0.03, 4.0):
+            reg.observe("lambda_micro_batch_duration_seconds", value)
+        reg.inc("lambda_files_ingested_total", 3, layer="unit")
+        reg.flush()
+        self.assertIn('le="+Inf"', render_prometheus())
+        ops = summarize()
+        self.assertGreaterEqual(ops['lambda_micro_batch_duration_count'], 4)
+        self.assertGreater(ops['lambda_micro_batch_duration_p95_seconds'], 0.03)
+        self.assertGreaterEqual(ops['lambda_files_ingested_total'], 3)
+
+    def test_31a_metrics_reserved_job_label(self):
+        reg = MetricsRegistry("unit_test")
+        with self.assertRaises(ValueError):
+            reg.observe("lambda_batch_job_duration_seconds", 1.0, job="user_refresh")
+        # A snapshot carrying one (written before labels were checked) doesn't duplicate the job's series
+        snap = reg.snapshot()
+        snap["counters"].append({"name": "lambda_files_ingested_total", "labels": {"job": "stale"}, "value": 1})
+        with open(reg.snapshot_path, 'w') as f:
+            json.dump(snap, f)
+        self.assertNotIn('job="stale"', render_prometheus())
+        reloaded = MetricsRegistry("unit_test")
+        self.assertFalse(any(dict(l).get("job") for _, l in reloaded._counters))
+
+        refresh_user_enrichment()
+        text = render_prometheus()
+        self.assertIn('lambda_batch_job_duration_seconds_count{job="batch",run="user_refresh"}', text)
+        series = [line.rsplit(" ", 1)[0] for line in text.splitlines() if not line.startswith("#")]
+        self.assertEqual(len(series), len(set(series)))
+
+    def test_32_profile_batch_report(self):
+        process_batch(profile=True)
+        reports = list_reports("batch")
+        self.assertTrue(len(reports) > 0)
+        report = load_report(reports[-1])
+        stages = {s['stage']: s for s in report['stages']}
+        self.assertListEqual(list(stages), ['read_json', 'stage_history', 'partition', 'sketches', 'verify_output', 'txid_index'])
+        self.assertTrue(all(len(s['queries']) == 1 for s in report['stages'] if s['stage'] == 'sketches'))
+        self.assertGreater(stages['read_json']['rows'], 0)
+        self.assertEqual(stages['stage_history']['rows'], stages['verify_output']['rows'])
+        # One record per partition, collected from the pool workers
+        partitions = [s for s in report['stages'] if s['stage'] == 'partition']
+        self.assertEqual(sum(s['rows'] for s in partitions), stages['verify_output']['rows'])
+        write_ops = {op['operator'] for s in partitions for q in s['queries'] for op in q['operators']}
+        self.assertTrue({'HASH_JOIN', 'COPY_TO_FILE'}.issubset(write_ops))
+        self.assertTrue(len(top_operators(report)) > 0)
+        # Footer reads and the id map sort are profiled like every other stage
+        self.assertTrue(stages['txid_index']['queries'])
+        # The run's elapsed time, not a sum of stages that may overlap in workers
+        self.assertGreaterEqual(report['total_seconds'], max(s['wall_seconds'] for s in report['stages']))
+
+        # Comparisons sum every record of a stage instead of matching arbitrary ones
+        diff = {r['stage']: r for r in compare_reports(report, report)}
+        self.assertEqual(list(diff), list(stages))
+        self.assertEqual(diff['partition']['after_count'], len(partitions))
+        self.assertEqual(diff['partition']['after_rows'], stages['verify_output']['rows'])
+        self.assertAlmostEqual(diff['partition']['after_seconds'], sum(s['wall_seconds'] for s in partitions))
+        self.assertEqual(diff['partition']['delta_seconds'], 0)
+
+    def test_32a_profile_speed_report(self):
+        simulate_streaming(interval_sec=0, duration_sec=0.01)
+        self.assertGreater(process_stream_micro_batch(profile=True), 0)
+        report = load_report(list_reports("speed")[-1])
+        # Every query of the micro-batch is recorded in a stage, sketches and the lag probe included
+        for name in ('ingest_file', 'sketches', 'event_lag'):
+            stages = [s for s in report['stages'] if s['stage'] == name]
+            self.assertTrue(len(stages) > 0, name)
+            self.assertTrue(all(len(s['queries']) == 1 for s in stages), name)
+            if name != 'event_lag':  # DuckDB answers MIN from Parquet statistics and emits no operator profile
+                self.assertTrue(all(q['operators'] for s in stages for q in s['queries']), name)
+
+    def test_33_profile_disabled_by_default(self):
+        before = len(list_reports("batch"))
+        process_batch()
+        self.assertEqual(len(list_reports("batch")), before)
+
+    # --- Workload Profile Tests ---
+
+    def test_40_workload_batch_skew_and_duplicates(self):
+        generate_batch_history(num_records=2000, profile="adversarial")
+        df = pd.read_json(os.path.join(TEST_DIR, "data", "raw", "batch", "history.json"), lines=True)
+        # Zipf(1.5) over 1000 users puts ~39% of traffic on the hottest user
+        self.assertGreater(df['user_id'].value_counts().iloc[0] / len(df), 0.3)
+        self.assertGreaterEqual(len(df) - df['transaction_id'].nunique(), 150)
+
+        process_batch()
+        batch_files = os.path.join(current_generation(), "*.parquet")
+        dedup = ServingLayer().con.query(f"SELECT COUNT(*) - COUNT(DISTINCT transaction_id) FROM read_parquet('{batch_files}')").fetchone()[0]
+        self.assertEqual(dedup, 0)
+
+    def test_41_workload_stream_late_duplicate_replay(self):
+        events = generate_stream_events(500, profile="adversarial")
+        cutoff = (datetime.now() - timedelta(seconds=60)).strftime("%Y-%m-%d %H:%M:%S")
+        self.assertTrue(any(e['timestamp'] < cutoff for e in events))
+        tx_ids = [e['transaction_id'] for e in events]
+        self.assertLess(len(set(tx_ids)), len(tx_ids))
+
+        # Stream events reappear in the next batch history drop as COMPLETED
+        generate_batch_history(num_records=10, profile="adversarial")
+        batch_dir = os.path.join(TEST_DIR, "data", "raw", "batch")
+        replayed = [f for f in os.listdir(batch_dir) if f.startswith("replayed_")]
+        self.assertTrue(len(replayed) > 0)
+        df = pd.read_json(os.path.join(batch_dir, replayed[-1]), lines=True)
+        self.assertTrue(set(df['transaction_id']).issubset(set(tx_ids)))
+        self.assertTrue((df['status'] == 'COMPLETED').all())
+        self.assertFalse(os.path.exists(os.path.join(TEST_DIR, "data", "raw", "stream_ledger.jsonl")))
+
+    def test_42_workload_uniform_default(self):
+        events = generate_stream_events(200)
+        cutoff = (datetime.now() - timedelta(seconds=60)).strftime("%Y-%m-%d %H:%M:%S")
+        self.assertTrue(all(e['timestamp'] >= cutoff for e in events))
+        self.assertTrue(all(e['status'] == 'PENDING' for e in events))
+        self.assertFalse(os.path.exists(os.path.join(TEST_DIR, "data", "raw", "stream_ledger.jsonl")))
+
     # --- Edge Cases ---
 
     def test_EC01_empty_batch_file(self):